@@ -0,0 +1,119 @@
+# Builds the benchmark page corpus in benchmarks/fixtures/.
+#
+# The pages mirror the layout of real Target PDPs as the monitor sees them: a large
+# <head> with the __TGT_DATA__ script (JSON.parse of an escaped JSON literal holding
+# __PRELOADED_QUERIES__, with the get-pdp-v1 entry somewhere in the middle), a long
+# body of markup and the ATC buttons near the end. labels.json records the verdict
+# each page must produce.
+#
+#   python benchmarks/make_fixtures.py [--filler 500]
+import argparse
+import json
+import os
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+TCIN = "94336414"
+
+def product(tcin, reason="IN_STOCK", eligible=True, purchasable=True, order_limit=2, street_date=None):
+    return {
+        "tcin": tcin,
+        "purchasable": purchasable,
+        "price": {"current_retail": 49.99, "formatted_current_price": "$49.99"},
+        "item": {
+            "product_description": {
+                "title": "Pokémon Trading Card Game: Scarlet & Violet—Booster Bundle",
+                "bullet_descriptions": ["<B>Includes:</B> 6 booster packs"] * 8,
+            },
+            "fulfillment": {
+                "purchasing_channel_eligibility": [
+                    {"channel": "STORE", "is_eligible": True, "reason": "AVAILABLE"},
+                    {"channel": "ONLINE", "is_eligible": eligible, "reason": reason},
+                ],
+                "shipping_options": {"order_limit": order_limit, "availability_status": reason},
+            },
+            "mmbv_content": {"street_date": street_date} if street_date else {},
+        },
+    }
+
+def tgt_data(tcin, pdp_product, extra_queries):
+    queries = []
+    for i in range(extra_queries):
+        queries.append([["@web/domain-product/get-recommendations-v1", {"tcin": tcin, "placement": i}],
+                        {"data": {"recommended_products": [
+                            {"tcin": str(80000000 + i * 50 + j), "title": "Related \"item\" \\ #%d" % j,
+                             "image": "https://target.scene7.com/is/image/Target/GUEST_%032d" % j}
+                            for j in range(20)]}}])
+    # A pdp entry for a different TCIN ahead of ours, as on bundle / variation pages.
+    queries.append([["@web/domain-product/get-pdp-v1", {"tcin": "12345678", "store_id": "3991"}],
+                    {"data": {"product": product("12345678", "OUT_OF_STOCK", eligible=False)}}])
+    if pdp_product is not None:
+        queries.append([["@web/domain-product/get-pdp-v1", {"tcin": tcin, "store_id": "3991", "pricing_store_id": "3991"}],
+                        {"data": {"product": pdp_product}}])
+    for i in range(extra_queries):
+        queries.append([["@web/domain-fulfillment/get-store-fulfillment-v1", {"tcin": tcin, "page": i}],
+                        {"data": {"stores": [{"store_id": str(1000 + j), "name": "Target Café %d" % j} for j in range(30)]}}])
+    return {"__PRELOADED_QUERIES__": {"queries": queries}, "__CONFIG__": {"services": {"redsky": {"apiKey": "x" * 40}}}}
+
+def js_string_literal(value):
+    # How the page embeds the payload: JSON text, escaped into a double-quoted JS string
+    # with non-ASCII characters as \uXXXX escapes.
+    text = json.dumps(value, ensure_ascii=False).replace("\\", "\\\\").replace('"', '\\"')
+    return '"' + "".join(c if ord(c) < 128 else "\\u%04x" % ord(c) for c in text) + '"'
+
+def page(pdp_product, button="active", with_tgt_data=True, filler=500, extra_queries=16, tcin=TCIN):
+    head = ['<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Target</title>',
+            # Decoy: the button marker inside a script must not count as a button.
+            '<script>window.__ATC_TEST_ID__="addToCartButton";if(window.a<2){window.b=1}</script>']
+    head += ['<link rel="preload" as="script" href="/_next/static/chunks/%d.js">' % i for i in range(60)]
+    if with_tgt_data:
+        head.append("<script>Object.defineProperties(window,{'__TGT_DATA__':{configurable:false,enumerable:true,"
+                    "value:deepFreeze(JSON.parse(" + js_string_literal(tgt_data(tcin, pdp_product, extra_queries)) + ")),"
+                    "writable:false},'__WEB_CLUSTER__':{configurable:false,enumerable:true,"
+                    "value:deepFreeze(JSON.parse(\"{}\")),writable:false}});</script>")
+    head.append("</head>")
+    body = ['<body><div id="pageBodyContainer">']
+    body += ['<div class="styles__StyledCol-sc-fw90uk-0"><span class="h-text-sm">Détails %d</span></div>' % i for i in range(filler)]
+    if button == "active":
+        body.append('<button class="styles__StyledButton" data-test="addToCartButton" type="button" aria-disabled="false">Add to cart</button>')
+    elif button == "disabled":
+        body.append('<button class="styles__StyledButton" disabled="" data-test="addToCartButton" type="button">Out of stock</button>')
+    elif button == "shipping":
+        body.append('<button data-test="addToCartButton" disabled>Sold out</button>'
+                    '<button class="styles__StyledButton" data-test="shippingButton" type="button">Ship it</button>')
+    body += ['<footer>'] + ['<a href="/c/%d">Category %d</a>' % (i, i) for i in range(300)] + ['</footer></div></body></html>']
+    return ("".join(head) + "".join(body)).encode("utf-8")
+
+CASES = {
+    # name: (page kwargs, expected in_stock, description)
+    "in_stock": (dict(pdp_product=product(TCIN)), True, "Active ATC button, ONLINE IN_STOCK"),
+    "in_stock_shipping_button": (dict(pdp_product=product(TCIN), button="shipping"), True, "ATC disabled but shipping button active"),
+    "out_of_stock": (dict(pdp_product=product(TCIN, "OUT_OF_STOCK", eligible=False, order_limit=0), button="disabled"), False, "Disabled button, ONLINE OUT_OF_STOCK"),
+    "disabled_button": (dict(pdp_product=product(TCIN), button="disabled"), False, "JSON says in stock but the button is disabled"),
+    "no_button": (dict(pdp_product=product(TCIN), button="none"), False, "No ATC button at all"),
+    "json_out_of_stock": (dict(pdp_product=product(TCIN, "OUT_OF_STOCK")), False, "Active button, ONLINE reason OUT_OF_STOCK"),
+    "order_limit_zero": (dict(pdp_product=product(TCIN, order_limit=0)), False, "ONLINE IN_STOCK but shipping order_limit 0"),
+    "not_purchasable": (dict(pdp_product=product(TCIN, purchasable=False)), False, "purchasable is false"),
+    "pre_order": (dict(pdp_product=product(TCIN, "PREORDER_SELLABLE", street_date="2099-01-01")), False, "Pre-order with a future street date"),
+    "pre_order_released": (dict(pdp_product=product(TCIN, "PREORDER_SELLABLE", street_date="2020-01-01")), True, "Pre-order whose street date has passed"),
+    "missing_tgt_data": (dict(pdp_product=product(TCIN), with_tgt_data=False), False, "Active button but no __TGT_DATA__ script"),
+    "missing_pdp_entry": (dict(pdp_product=None), False, "__TGT_DATA__ without a get-pdp-v1 entry for the TCIN"),
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filler", type=int, default=500, help="Markup blocks per page body")
+    args = parser.parse_args()
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    labels = {}
+    for name, (kwargs, expected, description) in CASES.items():
+        filename = f"{name}.html"
+        with open(os.path.join(FIXTURES_DIR, filename), "wb") as f:
+            f.write(page(filler=args.filler, **kwargs))
+        labels[filename] = {"tcin": TCIN, "in_stock": expected, "description": description}
+    with open(os.path.join(FIXTURES_DIR, "labels.json"), "w") as f:
+        json.dump(labels, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {len(labels)} fixtures to {FIXTURES_DIR}")
+
+if __name__ == "__main__":
+    main()
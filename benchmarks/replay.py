@@ -0,0 +1,241 @@
+# Replays a capture archive (see CAPTURE_DIR) through the monitor's real scheduler, page
+# parsers and alert path on a simulated clock, and reports restock-to-alert latency:
+#
+#   python benchmarks/replay.py captures/ --output replay_results.json
+#   python benchmarks/replay.py captures/ --interval 10 --hot-interval 2 --requests-per-minute 120
+#   python benchmarks/replay.py /tmp/drill --synthetic 20 --hours 6   # write a drill archive first
+#
+# A replayed check at simulated time t sees the newest page captured for that TCIN at or
+# before t (a captured failure replays as that failure), and finishes after the captured
+# fetch time. Ground truth comes from the capture itself: a restock is the first captured
+# page that parses as in stock after one that parsed as out of stock, and its latency runs
+# from that page's capture time to the moment update_alert_state queued the alert. A
+# restock that sold out again before any alert is counted as missed. Street dates are
+# still judged against the real date.
+import argparse
+import bisect
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import target_restock_monitor as monitor # noqa: E402
+from run_benchmarks import fresh_change_detector, git_revision, quiet # noqa: E402
+from stand_in_server import load_corpus # noqa: E402
+
+class Timeline:
+    # Captured fetches per TCIN in time order; 304s carry the previous body forward.
+    def __init__(self, records):
+        self.records = {}
+        self.urls = {}
+        for record in sorted(records, key=lambda record: record.at):
+            history = self.records.setdefault(record.tcin, [])
+            if record.body is None and record.status == 304 and history:
+                record = record._replace(body=history[-1].body, encoding=history[-1].encoding)
+            history.append(record)
+            self.urls[record.tcin] = record.url
+        self.times = {tcin: [record.at for record in history] for tcin, history in self.records.items()}
+
+    @property
+    def start(self):
+        return min(times[0] for times in self.times.values())
+
+    @property
+    def end(self):
+        return max(times[-1] for times in self.times.values())
+
+    def at(self, tcin, now):
+        i = bisect.bisect_right(self.times.get(tcin, ()), now)
+        return self.records[tcin][i - 1] if i else None
+
+def page_verdict(tcin, record):
+    return monitor.analyze_page(tcin, record.body, record.encoding or "utf-8", record.url)
+
+def find_restocks(timeline):
+    # [(tcin, restocked_at, sold_out_at or None)] from the captured pages' own verdicts.
+    restocks = []
+    for tcin, history in timeline.records.items():
+        previous, open_restock = None, None
+        for record in history:
+            if record.body is None:
+                continue
+            in_stock = page_verdict(tcin, record).in_stock
+            if in_stock and previous is False:
+                open_restock = [tcin, record.at, None]
+                restocks.append(open_restock)
+            elif not in_stock and open_restock is not None:
+                open_restock[2] = record.at
+                open_restock = None
+            previous = in_stock
+    return [tuple(restock) for restock in restocks]
+
+def replay(timeline, products, requests_per_minute, seed):
+    # Runs the scheduler over the captured window; returns ([(tcin, queued_at)], checks).
+    monitor.alerted_items.clear()
+    monitor.DISCORD_WEBHOOK_URL = "replay://"
+    dispatcher = monitor._alert_dispatcher = monitor.AlertDispatcher("replay://") # Never started: alerts stay queued
+    scheduler = monitor.Scheduler(rng=random.Random(seed))
+    now, end = timeline.start, timeline.end
+    budget = monitor.TokenBucket(requests_per_minute, now=now)
+    for product in products:
+        scheduler.add(product, now)
+
+    alerts, checks = [], 0
+    while True:
+        due = scheduler.pop_due(now, budget.available(now))
+        budget.consume(len(due), now)
+        for entry in due:
+            product = entry.product
+            record = timeline.at(product.tcin, now)
+            finished = now + ((record.elapsed or 0.0) if record is not None else 0.0)
+            if record is None:
+                result = monitor.CheckResult(None, None, "not_captured")
+            elif record.body is None:
+                result = monitor.CheckResult(None, None, record.failure or f"http_{record.status}")
+            else:
+                result = page_verdict(product.tcin, record)
+            if result.in_stock is not None:
+                monitor.update_alert_state(product, result.in_stock)
+            while not dispatcher.queue.empty():
+                dispatcher.queue.get_nowait()
+                alerts.append((product.tcin, finished))
+            scheduler.reschedule(product.tcin, result, finished)
+            checks += 1
+        next_due = scheduler.next_due()
+        if next_due is None or next_due > end:
+            return alerts, checks
+        now = max(next_due, now + budget.wait_time(now))
+
+def match_alerts(restocks, alerts):
+    # Pairs each restock with the first alert for its TCIN inside the in-stock window.
+    by_tcin = {}
+    for tcin, queued_at in sorted(alerts, key=lambda alert: alert[1]):
+        by_tcin.setdefault(tcin, []).append(queued_at)
+    matched, used = [], set()
+    for tcin, restocked_at, sold_out_at in sorted(restocks, key=lambda restock: restock[1]):
+        latency = None
+        for i, queued_at in enumerate(by_tcin.get(tcin, ())):
+            if (tcin, i) not in used and queued_at >= restocked_at and (sold_out_at is None or queued_at < sold_out_at):
+                used.add((tcin, i))
+                latency = queued_at - restocked_at
+                break
+        matched.append({"tcin": tcin, "restocked_at": restocked_at, "sold_out_at": sold_out_at, "latency_s": latency})
+    return matched, len(alerts) - len(used)
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 3)
+    return {"p50_s": percentile(0.5), "p90_s": percentile(0.9), "p99_s": percentile(0.99),
+            "max_s": round(ordered[-1], 3), "mean_s": round(statistics.mean(ordered), 3)}
+
+def write_synthetic_capture(directory, products, hours, seed):
+    # A drill archive from the fixture corpus: each product sits out of stock with a few
+    # in-stock windows of 2-20 minutes. Only page changes are captured, which is all the
+    # replay needs since a page stays as captured until the next record.
+    pages, labels = load_corpus()
+    fixture_tcin = labels["in_stock.html"]["tcin"]
+    rng = random.Random(seed)
+    archive = monitor.CaptureArchive(directory, max_queued=0).start() # Unbounded: a drill must not drop pages
+    start = time.time() - hours * 3600
+    for n in range(products):
+        tcin = str(90000000 + n)
+        url = f"https://www.target.com/p/drill-{n}/-/A-{tcin}"
+        at = start
+        in_stock = False
+        while at < start + hours * 3600:
+            fixture = "in_stock" if in_stock else "out_of_stock"
+            archive.record(tcin, url, 200, "utf-8", pages[fixture].replace(fixture_tcin.encode(), tcin.encode()),
+                           rng.uniform(0.2, 0.6), at=at)
+            at += rng.uniform(120, 1200) if in_stock else rng.uniform(600, 7200)
+            in_stock = not in_stock
+    archive.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture_dir")
+    parser.add_argument("--output", default="replay_results.json")
+    parser.add_argument("--watchlist", help="Watchlist file for product names and intervals (defaults: TCIN, --interval)")
+    parser.add_argument("--interval", type=float, default=monitor.CHECK_INTERVAL, help="Base check interval in seconds")
+    parser.add_argument("--hot-interval", type=float, default=monitor.HOT_INTERVAL)
+    parser.add_argument("--max-backoff", type=float, default=monitor.MAX_BACKOFF_INTERVAL)
+    parser.add_argument("--requests-per-minute", type=float, default=monitor.REQUESTS_PER_MINUTE)
+    parser.add_argument("--parse-workers", type=int, default=0, help="Parser processes (0 parses inline)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--synthetic", type=int, default=0, metavar="PRODUCTS",
+                        help="First write a drill archive with this many products into capture_dir")
+    parser.add_argument("--hours", type=float, default=6.0, help="Length of the --synthetic drill archive")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        write_synthetic_capture(args.capture_dir, args.synthetic, args.hours, args.seed)
+
+    started = time.perf_counter()
+    timeline = Timeline(monitor.read_capture_archive(args.capture_dir))
+    if not timeline.records:
+        print(f"No captures found in {args.capture_dir}")
+        sys.exit(1)
+    configured = {}
+    if args.watchlist:
+        watchlist = monitor.Watchlist(args.watchlist)
+        watchlist.refresh()
+        configured = watchlist.products
+    products = [configured.get(tcin) or monitor.Product(tcin, f"TCIN {tcin}", url, args.interval)
+                for tcin, url in sorted(timeline.urls.items())]
+
+    monitor.HOT_INTERVAL = args.hot_interval
+    monitor.MAX_BACKOFF_INTERVAL = args.max_backoff
+    monitor.PARSE_WORKERS = args.parse_workers
+    try:
+        with quiet():
+            fresh_change_detector()
+            restocks = find_restocks(timeline)
+            fresh_change_detector()
+            alerts, checks = replay(timeline, products, args.requests_per_minute, args.seed)
+    finally:
+        monitor.shutdown_parse_pool()
+    matched, unmatched_alerts = match_alerts(restocks, alerts)
+    elapsed = time.perf_counter() - started
+
+    latencies = [restock["latency_s"] for restock in matched if restock["latency_s"] is not None]
+    simulated = timeline.end - timeline.start
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_revision": git_revision(),
+        "parameters": vars(args),
+        "products": len(products),
+        "captured_fetches": sum(len(history) for history in timeline.records.values()),
+        "simulated_seconds": round(simulated, 1),
+        "wall_seconds": round(elapsed, 2),
+        "speedup": round(simulated / elapsed, 1) if elapsed else None,
+        "checks": checks,
+        "restocks": len(matched),
+        "detected": len(latencies),
+        "missed": len(matched) - len(latencies),
+        "alerts_without_restock": unmatched_alerts,
+        "latency": latency_summary(latencies),
+        "restock_detail": matched,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+    print(f"Replayed {results['simulated_seconds']}s of captures for {len(products)} products in "
+          f"{results['wall_seconds']}s ({results['speedup']}x), {checks} checks.")
+    print(f"{len(matched)} restocks: {len(latencies)} alerted, {results['missed']} missed, "
+          f"{unmatched_alerts} alerts without a captured restock.")
+    if latencies:
+        summary = results["latency"]
+        print(f"Restock-to-alert latency: p50 {summary['p50_s']}s, p90 {summary['p90_s']}s, "
+              f"p99 {summary['p99_s']}s, max {summary['max_s']}s.")
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# Reproducible benchmarks for the restock monitor's check path.
+#
+# Runs against the recorded-page corpus in benchmarks/fixtures/ and a local stand-in
+# server, and writes machine-readable results so runs can be compared:
+#
+#   python benchmarks/run_benchmarks.py --output bench_results.json
+#   python benchmarks/run_benchmarks.py --sizes 10,100,500 --latency-ms 50 --error-rate 0.01
+#   python benchmarks/run_benchmarks.py --sizes 200 --throttle-rate 0.1 --block-rate 0.02
+#
+# Every run first asserts that each fixture still produces its labelled verdict, both
+# from the in-process parse path and end to end over HTTP, and that the product API
+# path (batched, single-TCIN and per store) agrees with it; a mismatch fails the run, as
+# does any wrong verdict in the sweeps (unknown verdicts are allowed under injected faults)
+# or a runtime gauge missing from /metrics.
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import target_restock_monitor as monitor # noqa: E402
+from stand_in_server import NEARBY_STORES, load_corpus, start_stand_in_server # noqa: E402
+
+@contextlib.contextmanager
+def quiet():
+    # The monitor logs every step; keep that out of the timings and the report.
+    logging.disable(logging.CRITICAL)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "median_ms": round(statistics.median(ordered) * 1000, 4),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 4),
+        "min_ms": round(ordered[0] * 1000, 4),
+    }
+
+def time_call(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def fresh_change_detector():
+    # Benchmarks measure the full parse unless they are explicitly about the cache.
+    monitor.change_detector = monitor.ChangeDetector()
+
+def fresh_fetch_governor():
+    # Breaker and throttle state from one run shouldn't slow down the next.
+    monitor.fetch_governor = monitor.FetchGovernor()
+
+def check_labels(pages, labels, server):
+    # Also checks that the sequential end-to-end fetches stay on the client's keep-alive
+    # pool; returns (failures, distinct client connections the stand-in saw).
+    failures = []
+    with server._lock:
+        server.connections.clear()
+    for filename, label in labels.items():
+        fixture = os.path.splitext(filename)[0]
+        fresh_change_detector()
+        with quiet():
+            parsed = monitor.analyze_page(label["tcin"], pages[fixture]).in_stock
+            fetched = monitor.check_product(server.product_url(fixture)).in_stock
+        for path, verdict in (("parse", parsed), ("end_to_end", fetched)):
+            if verdict != label["in_stock"]:
+                failures.append(f"{fixture} ({path}): expected {label['in_stock']}, got {verdict}")
+    connections = len(server.connections)
+    if connections > monitor.HTTP_POOL_SIZE:
+        failures.append(f"{len(labels)} sequential checks opened {connections} connections, "
+                        f"more than the pool's {monitor.HTTP_POOL_SIZE}")
+    return failures, connections
+
+@contextlib.contextmanager
+def api_mode(server, batch_size):
+    # Points the monitor's product API at the stand-in for the duration.
+    names = ("FETCH_MODE", "PRODUCT_API_URL", "PRODUCT_API_BATCH_URL", "STORE_LOOKUP_URL", "PRODUCT_API_BATCH_SIZE")
+    saved = {name: getattr(monitor, name) for name in names}
+    monitor.FETCH_MODE = "api"
+    monitor.PRODUCT_API_URL = server.api_url("pdp_client_v1")
+    monitor.PRODUCT_API_BATCH_URL = server.api_url("product_summary_with_fulfillment_v1")
+    monitor.STORE_LOOKUP_URL = server.api_url("nearby_stores_v1")
+    monitor.PRODUCT_API_BATCH_SIZE = batch_size
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(monitor, name, value)
+
+def check_api_mode(labels, server):
+    # FETCH_MODE=api must reach the same verdict as the page for every label: in one batch
+    # that the API only partly answers, one TCIN per request, and per store in store mode.
+    # A refused batch must come back unknown without falling back to page fetches.
+    failures = []
+    fixtures = {os.path.splitext(filename)[0]: label for filename, label in labels.items()}
+    products = [monitor.Product(tcin, fixture, server.product_url(fixture, tcin), monitor.CHECK_INTERVAL)
+                for tcin, fixture in ((str(30000000 + i), fixture) for i, fixture in enumerate(sorted(fixtures)))]
+    unanswered = [product for product in products if server.products[product.name] is None]
+    engine = monitor.CheckEngine(max_workers=4, host_limiter=monitor.HostLimiter(max_in_flight=4, min_delay=0.0))
+    try:
+        with quiet():
+            fresh_fetch_governor()
+            html = {product.tcin: result.in_stock for product, result in engine.run_sweep(products)}
+        for batch_size, path in ((len(products), "api_batch"), (1, "api_single")):
+            fresh_change_detector()
+            served = server.requests_served
+            with quiet(), api_mode(server, batch_size):
+                api = {product.tcin: result.in_stock for product, result in engine.run_sweep(products)}
+            requests = server.requests_served - served
+            expected_requests = -(-len(products) // batch_size) + len(unanswered)
+            if requests != expected_requests:
+                failures.append(f"{path}: {requests} requests for {len(products)} products, expected {expected_requests}")
+            for product in products:
+                label = fixtures[product.name]["in_stock"]
+                if not api.get(product.tcin) == html.get(product.tcin) == label:
+                    failures.append(f"{product.name} ({path}): expected {label}, got api {api.get(product.tcin)}, "
+                                    f"html {html.get(product.tcin)}")
+
+        stores = ["2001", "2002"]
+        with quiet(), api_mode(server, 5):
+            store_monitor = monitor.StoreMonitor(engine, store_ids=stores, zips=["55401"])
+            store_monitor.start_sweep(products, time.monotonic())
+            seen = {}
+            while store_monitor.in_flight():
+                time.sleep(0.01)
+                seen.update(((product.tcin, status.store_id), status.available) for product, status in store_monitor.collect())
+        expected = {(product.tcin, store_id): fixtures[product.name]["in_stock"] and int(store_id) % 2 == 1
+                    for product in products if product not in unanswered for store_id in stores + NEARBY_STORES}
+        if seen != expected:
+            failures.append(f"store fan-out: {len(set(seen.items()) ^ set(expected.items()))} (tcin, store) verdicts "
+                            f"differ from the labels across {len(expected)} pairs")
+
+        served = server.requests_served
+        server.throttle_rate = 1.0
+        try:
+            with quiet(), api_mode(server, len(products)):
+                refused = [result for _, result in engine.run_sweep(products)]
+        finally:
+            server.throttle_rate = 0.0
+            fresh_fetch_governor()
+        if server.requests_served - served != 1 or any(result.in_stock is not None for result in refused):
+            failures.append(f"throttled api batch: {server.requests_served - served} requests, "
+                            f"{sum(result.in_stock is not None for result in refused)} known verdicts; expected 1 and 0")
+    finally:
+        engine.shutdown()
+    return failures
+
+RUNTIME_GAUGES = ("restock_checks_in_flight", "restock_products_scheduled", "restock_alert_queue_depth",
+                  "restock_state_pending_writes", "restock_capture_pending_writes", "restock_store_results_cached",
+                  "restock_shard_workers", "restock_change_detector_fingerprint_hits_total", "restock_circuit_open",
+                  "restock_identity_health")
+
+def check_runtime_metrics(labels, server):
+    # The /metrics callback only logs its exceptions, so a broken one just drops its gauges.
+    # Render it after a sweep (so the governor has host and identity stats) and look for them.
+    products = [monitor.Product(str(50000000 + i), fixture, server.product_url(fixture, str(50000000 + i)),
+                                monitor.CHECK_INTERVAL)
+                for i, fixture in enumerate(sorted(os.path.splitext(filename)[0] for filename in labels))]
+    engine = monitor.CheckEngine(max_workers=4, host_limiter=monitor.HostLimiter(max_in_flight=4, min_delay=0.0))
+    scheduler = monitor.Scheduler()
+    for product in products:
+        scheduler.add(product, time.monotonic())
+    registry = monitor.Metrics()
+    registry.register_callback(monitor.runtime_metrics(engine, scheduler, monitor.StateStore(os.devnull),
+                                                       monitor.StoreMonitor(engine, store_ids=[])))
+    try:
+        with quiet():
+            list(engine.run_sweep(products))
+            rendered = registry.render()
+    finally:
+        engine.shutdown()
+    names = {line.split("{")[0].split(" ")[0] for line in rendered.splitlines() if line and not line.startswith("#")}
+    return [f"/metrics is missing {name}" for name in RUNTIME_GAUGES if name not in names]
+
+def bench_stages(pages, labels, repeat):
+    results = {}
+    with quiet():
+        for filename, label in labels.items():
+            fixture = os.path.splitext(filename)[0]
+            results[fixture] = bench_fixture_stages(pages[fixture], label["tcin"], repeat)
+    return results
+
+def bench_fixture_stages(body, tcin, repeat):
+    parts = monitor.extract_page_parts(body)
+    stages = {
+        "extract_fast_path": lambda: monitor.extract_page_parts(body),
+        "extract_soup": lambda: monitor.extract_page_parts_with_soup(body),
+        "fingerprint": lambda: monitor.page_fingerprint(parts),
+    }
+    if parts.tgt_script:
+        stages["decode_pdp_selective"] = lambda: monitor.find_pdp_product(tcin, parts.tgt_script, tcin)
+        product = monitor.find_pdp_product(tcin, parts.tgt_script, tcin)
+        if product:
+            signals = monitor.pdp_signals(product)
+            stages["decide"] = lambda: monitor.decide_stock(tcin, signals)
+
+    def analyze_uncached():
+        fresh_change_detector()
+        monitor.analyze_page(tcin, body)
+
+    stages["analyze_page_uncached"] = analyze_uncached
+    monitor.analyze_page(tcin, body) # Prime the fingerprint cache
+    stages["analyze_page_cached"] = lambda: monitor.analyze_page(tcin, body)
+
+    return {
+        "bytes": len(body),
+        # The soup path is ~100x slower; fewer repetitions keep the run short.
+        "stages": {name: time_call(func, repeat if name != "extract_soup" else max(1, repeat // 10))
+                   for name, func in stages.items()},
+    }
+
+def watchlist(server, fixtures, size):
+    # Distinct TCINs so neither the fingerprint cache nor dedupe hides any work.
+    return {f"{fixtures[i % len(fixtures)]}-{i}": server.product_url(fixtures[i % len(fixtures)], str(20000000 + i))
+            for i in range(size)}
+
+def run_sweep(products, engine):
+    started = time.perf_counter()
+    with quiet():
+        verdicts = list(engine.run_sweep(products))
+    return time.perf_counter() - started, verdicts
+
+def bench_sweeps(server, fixtures, labels, sizes, concurrency, sweeps):
+    # Under throttling/blocking, failed checks must come back "unknown", never as a wrong verdict.
+    # Without injected faults (whose responses are closed rather than reused) and with no more
+    # workers than pooled connections, every sweep must stay on the client's keep-alive pool.
+    pooled = concurrency <= monitor.HTTP_POOL_SIZE and not (server.error_rate or server.throttle_rate or server.block_rate)
+    expected = {os.path.splitext(filename)[0]: label["in_stock"] for filename, label in labels.items()}
+    results = []
+    for size in sizes:
+        products = watchlist(server, fixtures, size)
+        engine = monitor.CheckEngine(max_workers=concurrency,
+                                     host_limiter=monitor.HostLimiter(max_in_flight=concurrency, min_delay=0.0))
+        durations = []
+        checks = 0
+        unknown = 0
+        wrong = 0
+        fresh_fetch_governor()
+        with server._lock:
+            server.connections.clear()
+        try:
+            for _ in range(sweeps):
+                fresh_change_detector()
+                duration, verdicts = run_sweep(products, engine)
+                durations.append(duration)
+                checks += len(verdicts)
+                for product, result in verdicts:
+                    if result is None or result.in_stock is None:
+                        unknown += 1
+                    elif result.in_stock != expected[product.name.rsplit("-", 1)[0]]:
+                        wrong += 1
+        finally:
+            engine.shutdown()
+        results.append({
+            "watchlist_size": size,
+            "concurrency": concurrency,
+            "parse_workers": monitor.PARSE_WORKERS,
+            "sweeps": sweeps,
+            "median_sweep_s": round(statistics.median(durations), 4),
+            "checks_per_second": round(checks / sum(durations), 2),
+            "known_verdicts_per_second": round((checks - unknown) / sum(durations), 2),
+            "unknown_verdicts": unknown,
+            "wrong_verdicts": wrong,
+            "client_connections": len(server.connections),
+            "connections_within_pool": len(server.connections) <= monitor.HTTP_POOL_SIZE if pooled else None,
+        })
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--repeat", type=int, default=50, help="Timing repetitions per parse stage")
+    parser.add_argument("--sizes", default="10,50,200", help="Watchlist sizes for the sweep benchmark")
+    parser.add_argument("--sweeps", type=int, default=3, help="Sweeps per watchlist size")
+    parser.add_argument("--concurrency", type=int, default=monitor.MAX_CONCURRENCY)
+    parser.add_argument("--parse-workers", type=int, default=monitor.PARSE_WORKERS,
+                        help="Parser processes for the sweep benchmark (0 parses in the fetch threads)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Stand-in server latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of sweep requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of sweep requests answered with 429")
+    parser.add_argument("--block-rate", type=float, default=0.0, help="Fraction of sweep requests answered with 403")
+    args = parser.parse_args()
+
+    pages, labels = load_corpus()
+    fixtures = sorted(pages)
+
+    server = start_stand_in_server(seed=1)
+    failures, label_connections = check_labels(pages, labels, server)
+    failures += check_api_mode(labels, server)
+    failures += check_runtime_metrics(labels, server)
+    if failures:
+        print("Pre-benchmark checks failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    server.shutdown()
+
+    stages = bench_stages(pages, labels, args.repeat)
+
+    server = start_stand_in_server(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                                   error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                   block_rate=args.block_rate, seed=1)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    monitor.PARSE_WORKERS = args.parse_workers
+    try:
+        sweeps = bench_sweeps(server, fixtures, labels, sizes, args.concurrency, args.sweeps)
+    finally:
+        monitor.shutdown_parse_pool()
+        monitor.PARSE_WORKERS = 0
+    server.shutdown()
+    wrong = sum(sweep["wrong_verdicts"] for sweep in sweeps)
+    pool_overruns = [sweep["watchlist_size"] for sweep in sweeps if sweep["connections_within_pool"] is False]
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "verdicts_match_labels": not wrong,
+        "http_pool_size": monitor.HTTP_POOL_SIZE,
+        "label_check_connections": label_connections,
+        "stages": stages,
+        "sweeps": sweeps,
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == "darwin" else 1),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+    for fixture, result in stages.items():
+        timings = ", ".join(f"{name} {timing['median_ms']}ms" for name, timing in result["stages"].items())
+        print(f"{fixture}: {timings}")
+    for sweep in sweeps:
+        print(f"watchlist {sweep['watchlist_size']}: {sweep['median_sweep_s']}s per sweep, {sweep['checks_per_second']} checks/s, "
+              f"{sweep['unknown_verdicts']} unknown, {sweep['wrong_verdicts']} wrong, "
+              f"{sweep['client_connections']} connections")
+    print(f"Peak RSS {results['peak_rss_kb']} KB. Results written to {args.output}")
+    if wrong:
+        print(f"{wrong} sweep verdicts contradict the fixture labels.")
+    if pool_overruns:
+        print(f"Sweeps of {', '.join(map(str, pool_overruns))} products opened more connections than the "
+              f"pool's {monitor.HTTP_POOL_SIZE}.")
+    if wrong or pool_overruns:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
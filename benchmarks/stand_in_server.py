@@ -0,0 +1,215 @@
+# Local HTTP stand-in for target.com that serves the benchmark corpus.
+#
+# GET /p/<fixture>/-/A-<tcin> returns benchmarks/fixtures/<fixture>.html with the
+# fixture's TCIN rewritten to <tcin>, so large watchlists get distinct pages from a
+# small corpus. Latency, jitter and error/throttle/block rates are configurable.
+#
+# The product API is stood in too, built from the same pages, so FETCH_MODE=api and
+# store mode can be checked against the labels:
+#
+#   GET /redsky_aggregations/v1/web/pdp_client_v1?tcin=<tcin>
+#   GET /redsky_aggregations/v1/web/product_summary_with_fulfillment_v1?tcins=<a,b>&store_id=<store>
+#   GET /redsky_aggregations/v1/web/nearby_stores_v1?place=<zip>
+#
+# A TCIN maps to the fixture it was last handed out for by product_url(). Pages with no
+# pdp product are left out of API answers, as the real API leaves out TCINs it doesn't
+# know, and pages with no active button are reported not eligible ONLINE. Pickup is
+# IN_STOCK at odd-numbered stores for in-stock fixtures and OUT_OF_STOCK everywhere else.
+#
+#   python benchmarks/stand_in_server.py --port 8765 --latency-ms 80 --error-rate 0.02
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import target_restock_monitor as monitor # noqa: E402
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+API_PATH = "/redsky_aggregations/v1/web/"
+NEARBY_STORES = ["1101", "1102", "1103"] # Every ZIP resolves to these
+
+def load_corpus(fixtures_dir=FIXTURES_DIR):
+    with open(os.path.join(fixtures_dir, "labels.json")) as f:
+        labels = json.load(f)
+    pages = {}
+    for filename in labels:
+        with open(os.path.join(fixtures_dir, filename), "rb") as f:
+            pages[os.path.splitext(filename)[0]] = f.read()
+    return pages, labels
+
+def api_product(page, tcin):
+    # The pdp product a page embeds, as the product API would serve it, or None if it has none.
+    parts = monitor.extract_page_parts(page)
+    product = monitor.find_pdp_product(tcin, parts.tgt_script, tcin) if parts.tgt_script else None
+    if not product:
+        return None
+    if not any(not disabled for _, disabled in parts.buttons):
+        product = json.loads(json.dumps(product))
+        for channel in product.get("item", {}).get("fulfillment", {}).get("purchasing_channel_eligibility", []):
+            if channel.get("channel") == "ONLINE":
+                channel.update(is_eligible=False, reason="OUT_OF_STOCK")
+    return product
+
+def store_options(store_ids, in_stock):
+    options = []
+    for store_id in store_ids:
+        status = "IN_STOCK" if in_stock and int(store_id) % 2 else "OUT_OF_STOCK"
+        options.append({"location_id": store_id, "location_name": f"Stand-in {store_id}",
+                        "location_available_to_promise_quantity": 3 if status == "IN_STOCK" else 0,
+                        "order_pickup": {"availability_status": status},
+                        "drive_up": {"availability_status": "UNAVAILABLE"},
+                        "in_store_only": {"availability_status": status}})
+    return options
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pages, labels, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 block_rate=0.0, seed=None):
+        super().__init__(address, StandInHandler)
+        self.pages = pages
+        self.tcins = {os.path.splitext(name)[0]: label["tcin"] for name, label in labels.items()}
+        self.in_stock = {os.path.splitext(name)[0]: label["in_stock"] for name, label in labels.items()}
+        self.products = {fixture: api_product(page, self.tcins[fixture]) for fixture, page in pages.items()}
+        self.fixture_for = {} # TCIN -> fixture, from product_url()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.block_rate = block_rate
+        self.rng = random.Random(seed)
+        self.requests_served = 0
+        self.connections = set()
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading once they have their verdict drop the connection mid-body.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def product_url(self, fixture, tcin=None):
+        tcin = tcin or self.tcins[fixture]
+        self.fixture_for[tcin] = fixture
+        return f"{self.base_url}/p/{fixture}/-/A-{tcin}"
+
+    def api_url(self, endpoint):
+        return f"{self.base_url}{API_PATH}{endpoint}"
+
+    def api_product(self, tcin):
+        fixture = self.fixture_for.get(tcin)
+        if fixture is None or self.products[fixture] is None:
+            return None
+        # Same TCIN rewrite as the pages; the fixture's TCIN appears only as a value.
+        return json.loads(json.dumps(self.products[fixture]).replace(self.tcins[fixture], tcin))
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real site
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server._lock:
+            server.requests_served += 1
+            server.connections.add(self.client_address)
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+            roll = server.rng.random()
+        if delay:
+            time.sleep(delay)
+        if roll < server.throttle_rate:
+            return self._send(429, b"Too Many Requests", {"Retry-After": "1"})
+        if roll < server.throttle_rate + server.error_rate:
+            return self._send(503, b"Service Unavailable")
+        if roll < server.throttle_rate + server.error_rate + server.block_rate:
+            return self._send(403, b"Access Denied")
+
+        if self.path.startswith(API_PATH):
+            return self._send_api(*urlsplit(self.path)[2:4])
+
+        parts = self.path.split("?")[0].split("/")
+        # /p/<fixture>/-/A-<tcin>
+        if len(parts) < 5 or parts[1] != "p" or parts[2] not in server.pages:
+            return self._send(404, b"Not Found")
+        fixture, tcin = parts[2], parts[-1][2:]
+        body = server.pages[fixture]
+        if tcin and tcin != server.tcins[fixture]:
+            body = body.replace(server.tcins[fixture].encode(), tcin.encode())
+        self._send(200, body, {"Content-Type": "text/html; charset=utf-8"})
+
+    def _send_api(self, path, query):
+        server = self.server
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        endpoint = path[len(API_PATH):]
+        if endpoint == "pdp_client_v1":
+            product = server.api_product(params.get("tcin", ""))
+            if product is None:
+                return self._send(404, b'{"errors": [{"message": "No product found"}]}', {"Content-Type": "application/json"})
+            data = {"product": product}
+        elif endpoint == "product_summary_with_fulfillment_v1":
+            store_ids = [params.get("store_id") or "3991"]
+            summaries = []
+            for tcin in params.get("tcins", "").split(","):
+                product = server.api_product(tcin)
+                if product is None:
+                    continue
+                # Summaries carry fulfillment next to item rather than inside it.
+                item = dict(product.get("item") or {})
+                fulfillment = dict(item.pop("fulfillment", {}))
+                fulfillment["store_options"] = store_options(store_ids, server.in_stock[server.fixture_for[tcin]])
+                summaries.append(dict(product, tcin=tcin, item=item, fulfillment=fulfillment))
+            data = {"product_summaries": summaries}
+        elif endpoint == "nearby_stores_v1":
+            data = {"nearby_stores": {"stores": [{"store_id": store_id} for store_id in NEARBY_STORES]}}
+        else:
+            return self._send(404, b"Not Found")
+        self._send(200, json.dumps({"data": data}).encode(), {"Content-Type": "application/json"})
+
+def start_stand_in_server(host="127.0.0.1", port=0, fixtures_dir=FIXTURES_DIR, **options):
+    pages, labels = load_corpus(fixtures_dir)
+    server = StandInServer((host, port), pages, labels, **options)
+    threading.Thread(target=server.serve_forever, name="stand-in-server", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--block-rate", type=float, default=0.0, help="Fraction of requests answered with 403")
+    args = parser.parse_args()
+    server = start_stand_in_server(args.host, args.port, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                                   error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                                   block_rate=args.block_rate)
+    print(f"Serving {len(server.pages)} fixtures at {server.base_url}/p/<fixture>/-/A-<tcin>")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
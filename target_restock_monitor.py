@@ -1,11 +1,33 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
 from bs4 import BeautifulSoup
 import time
+import sys
 import os
 import json # For parsing JSON data
+import csv
+import hashlib
+import gzip
+import zlib
 import re   # For regular expressions
-from urllib.parse import urlparse # For parsing URLs and robust filename generation
-from datetime import datetime, timezone # For checking pre-order street dates
+import threading
+import socket
+import logging
+import bisect
+import queue
+import sqlite3
+import heapq
+import random
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED # Concurrent product checks
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs # For parsing URLs and robust filename generation
+from datetime import datetime, timedelta, timezone # For checking pre-order street dates
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Local metrics endpoint
 
 # === CONFIG ===
 PRODUCTS = {
@@ -26,11 +48,581 @@ PRODUCTS = {
 }
 
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
-CHECK_INTERVAL = 30
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-}
-alerted_items = set()
+CHECK_INTERVAL = 30 # Base seconds between checks of one product
+# Optional per-product base intervals in seconds, keyed by the names in PRODUCTS.
+PRODUCT_INTERVALS = {}
+# Watchlist: a .json/.csv/.toml file, or a directory of them, replaces PRODUCTS and is reloaded when it changes.
+WATCHLIST_PATH = os.environ.get("WATCHLIST_PATH")
+WATCHLIST_POLL_INTERVAL = float(os.environ.get("WATCHLIST_POLL_INTERVAL", "5")) # Seconds between change checks
+# Request identities: fetches rotate across these header profiles (IDENTITY_PROFILES_PATH, a JSON list
+# of header objects, replaces them) and across EGRESS_PROXIES (comma-separated proxy URLs; empty = direct).
+DEFAULT_IDENTITY_PROFILES = [
+    {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36",
+     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", "Accept-Language": "en-US,en;q=0.9"},
+    {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36",
+     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", "Accept-Language": "en-US,en;q=0.9"},
+    {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:143.0) Gecko/20100101 Firefox/143.0",
+     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", "Accept-Language": "en-US,en;q=0.5"},
+    {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.6 Safari/605.1.15",
+     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8", "Accept-Language": "en-US,en;q=0.9"},
+]
+IDENTITY_PROFILES_PATH = os.environ.get("IDENTITY_PROFILES_PATH")
+EGRESS_PROXIES = os.environ.get("EGRESS_PROXIES", "")
+# Fetch governance: consecutive throttled/blocked/5xx answers open a host's circuit breaker for a
+# cooldown that doubles on repeat trips. Short Retry-After pauses are waited out; a 429 without one adds
+# request spacing that doubles per 429 and halves per success.
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+BREAKER_MAX_COOLDOWN = float(os.environ.get("BREAKER_MAX_COOLDOWN", "600"))
+THROTTLE_DELAY = float(os.environ.get("THROTTLE_DELAY", "0.5")) # Extra seconds between requests after a 429
+THROTTLE_MAX_DELAY = float(os.environ.get("THROTTLE_MAX_DELAY", "30"))
+# Concurrency: how many checks run at once overall, and how polite we are to a single host.
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "8"))
+PER_HOST_CONCURRENCY = int(os.environ.get("PER_HOST_CONCURRENCY", "4"))
+PER_HOST_MIN_DELAY = float(os.environ.get("PER_HOST_MIN_DELAY", "0.5")) # Seconds between request starts to one host
+# HTTP client: separate connect/read timeouts, pooled keep-alive connections, optional HTTP/2 (needs httpx[http2]).
+CONNECT_TIMEOUT = float(os.environ.get("CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", "20"))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(MAX_CONCURRENCY))) # Keep-alive connections per host
+HTTP_HOST_POOL_SIZES = os.environ.get("HTTP_HOST_POOL_SIZES", "discord.com=2") # e.g. "www.target.com=8,discord.com=2"
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "").lower() in ("1", "true", "yes")
+# Parsing: PARSE_WORKERS > 0 moves page analysis into that many parser processes (0 parses in the fetch threads).
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0"))
+PARSE_TIMEOUT = float(os.environ.get("PARSE_TIMEOUT", "10")) # Seconds before a single page's parse is abandoned
+# Streaming: read product pages in chunks and stop once the verdict inputs have arrived (STREAM_FETCH=0 reads it all).
+STREAM_FETCH = os.environ.get("STREAM_FETCH", "1").lower() in ("1", "true", "yes")
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(16 * 1024)))
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", str(8 * 1024 * 1024))) # Larger pages are an unknown verdict
+STREAM_DRAIN_BYTES = 64 * 1024 # After an early stop, bodies with at most this much left are read out to keep the connection
+# Fetch mode: "html" scrapes the product page, "api" asks Target's product API for JSON (HTML stays the fallback).
+FETCH_MODE = os.environ.get("FETCH_MODE", "html").lower()
+PRODUCT_API_URL = os.environ.get("PRODUCT_API_URL", "https://redsky.target.com/redsky_aggregations/v1/web/pdp_client_v1")
+PRODUCT_API_BATCH_URL = os.environ.get("PRODUCT_API_BATCH_URL", "https://redsky.target.com/redsky_aggregations/v1/web/product_summary_with_fulfillment_v1")
+PRODUCT_API_KEY = os.environ.get("PRODUCT_API_KEY", "9f36aeafbe60771e321a7cc95a78140772ab3e96") # Public key used by target.com's own front end
+PRODUCT_API_STORE_ID = os.environ.get("PRODUCT_API_STORE_ID", "3991")
+PRODUCT_API_BATCH_SIZE = int(os.environ.get("PRODUCT_API_BATCH_SIZE", "24")) # TCINs per API request
+API_NO_FALLBACK = ("throttled", "blocked", "circuit_open") # API failures that don't fall back to product pages
+# Store mode: pickup/drive-up availability at STORE_IDS and at the stores nearest STORE_ZIPS (both comma-separated),
+# checked through the product API alongside the online check. Alerts fire per (product, store).
+STORE_IDS = [store.strip() for store in os.environ.get("STORE_IDS", "").split(",") if store.strip()]
+STORE_ZIPS = [zip_code.strip() for zip_code in os.environ.get("STORE_ZIPS", "").split(",") if zip_code.strip()]
+STORE_ZIP_RADIUS = float(os.environ.get("STORE_ZIP_RADIUS", "10")) # Miles around each ZIP
+STORE_ZIP_LIMIT = int(os.environ.get("STORE_ZIP_LIMIT", "3")) # Nearest stores per ZIP
+STORE_LOOKUP_URL = os.environ.get("STORE_LOOKUP_URL", "https://redsky.target.com/redsky_aggregations/v1/web/nearby_stores_v1")
+STORE_CHECK_INTERVAL = float(os.environ.get("STORE_CHECK_INTERVAL", "60")) # Seconds between store sweeps
+STORE_RESULT_TTL = float(os.environ.get("STORE_RESULT_TTL", "45")) # Store answers younger than this aren't re-queried
+# Decision rules: a JSON rule set (format beside DEFAULT_RULES) replaces the built-in stock decision.
+RULES_PATH = os.environ.get("RULES_PATH", "")
+# Capture: raw product page fetches go to a rotating, compressed archive that benchmarks/replay.py
+# can play back (CAPTURE_DIR="" disables it).
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "")
+CAPTURE_SEGMENT_BYTES = int(os.environ.get("CAPTURE_SEGMENT_BYTES", str(64 * 1024 * 1024))) # Compressed size before rotating
+CAPTURE_KEEP_SEGMENTS = int(os.environ.get("CAPTURE_KEEP_SEGMENTS", "8")) # Newest segments kept on disk
+# Sharding: several workers split one watchlist by consistent hashing of TCINs. With SHARD_DB_PATH
+# (a SQLite file every worker can open) membership follows heartbeats, so shards rebalance as
+# workers come and go, and alert claims are shared. Otherwise each worker is WORKER_INDEX of a
+# fixed WORKER_COUNT; on Heroku the index defaults from the dyno name (worker.1 -> 0).
+_DYNO_NUMBER = os.environ.get("DYNO", "").rpartition(".")[2]
+SHARD_DB_PATH = os.environ.get("SHARD_DB_PATH", "")
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", str(int(_DYNO_NUMBER) - 1 if _DYNO_NUMBER.isdigit() else 0)))
+WORKER_ID = os.environ.get("WORKER_ID") or os.environ.get("DYNO") or f"{socket.gethostname()}-{os.getpid()}"
+SHARD_HEARTBEAT = float(os.environ.get("SHARD_HEARTBEAT", "5")) # Seconds between membership heartbeats
+SHARD_WORKER_TTL = float(os.environ.get("SHARD_WORKER_TTL", "20")) # Silent workers leave the ring after this
+SHARD_VNODES = 64 # Ring points per worker
+# Scheduling: unchanged products back off, products close to a restock go "hot".
+BACKOFF_FACTOR = float(os.environ.get("BACKOFF_FACTOR", "1.5"))
+MAX_BACKOFF_INTERVAL = float(os.environ.get("MAX_BACKOFF_INTERVAL", "300"))
+SCHEDULE_JITTER = float(os.environ.get("SCHEDULE_JITTER", "0.1")) # +/- fraction of each interval
+HOT_INTERVAL = float(os.environ.get("HOT_INTERVAL", "5"))
+HOT_CHECKS = int(os.environ.get("HOT_CHECKS", "24")) # Fast polls a hot product gets before cooling down
+HOT_STREET_DATE_DAYS = float(os.environ.get("HOT_STREET_DATE_DAYS", "2"))
+REQUESTS_PER_MINUTE = float(os.environ.get("REQUESTS_PER_MINUTE", "60")) # Global request budget
+REQUEST_BURST = int(os.environ.get("REQUEST_BURST", str(MAX_CONCURRENCY)))
+# Alerts: restocks queued within the window are merged into one Discord message (max 10 embeds).
+ALERT_COALESCE_WINDOW = float(os.environ.get("ALERT_COALESCE_WINDOW", "2"))
+ALERT_MAX_RETRIES = int(os.environ.get("ALERT_MAX_RETRIES", "5"))
+ALERT_MAX_EMBEDS = 10
+# Observability: log level, and a local Prometheus-style /metrics endpoint (METRICS_PORT=0 disables it).
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Status API: local JSON/SSE view of the latest verdicts for other tools (STATUS_PORT=0 disables it).
+STATUS_HOST = os.environ.get("STATUS_HOST", "127.0.0.1")
+STATUS_PORT = int(os.environ.get("STATUS_PORT", "0"))
+STATUS_EVENT_HISTORY = int(os.environ.get("STATUS_EVENT_HISTORY", "1000")) # Transitions kept for /events
+STATUS_MAX_WAIT = 60.0 # Longest a long poll may hold a request open
+STATUS_HEARTBEAT = 15.0 # Seconds between keep-alive comments on idle event streams
+SNAPSHOT_HISTORY = int(os.environ.get("SNAPSHOT_HISTORY", "8")) # Distinct signal snapshots kept per product
+# State: alert flags, last verdicts and stock transitions survive restarts in SQLite (STATE_DB_PATH="" disables it).
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "restock_state.db")
+STATE_FLUSH_INTERVAL = float(os.environ.get("STATE_FLUSH_INTERVAL", "1")) # Seconds between batched commits
+STATE_HISTORY_DAYS = float(os.environ.get("STATE_HISTORY_DAYS", "90")) # Transition history kept (0 keeps all)
+alerted_items = set() # TCINs alerted since they were last seen out of stock
+alerted_store_items = set() # (TCIN, store ID) pairs alerted since they were last seen unavailable
+
+# === LOGGING & METRICS ===
+log = logging.getLogger("target_restock_monitor")
+
+# Upper bounds (seconds) for per-stage timing histograms; parse stages are sub-millisecond, fetches are not.
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+class Metrics:
+    # Thread-safe counters, gauges and histograms rendered in the Prometheus text format.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._callbacks = []
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._types:
+            self._types[name] = kind
+            self._help[name] = help_text or name
+
+    def inc(self, name, amount=1, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, "histogram", help_text)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, buckets=STAGE_BUCKETS, help_text=None, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, buckets, help_text, **labels)
+
+    def stage(self, stage):
+        return self.timer("restock_stage_seconds", help_text="Time spent in each stage of a product check.", stage=stage)
+
+    def register_callback(self, callback):
+        # callback() returns [(name, kind, help, labels_dict, value)], sampled at render time.
+        self._callbacks.append(callback)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            samples = {}
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), value in self._gauges.items():
+                samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in self._histograms.items():
+                cumulative = 0
+                rows = samples.setdefault(name, [])
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    rows.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+                rows.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                rows.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                rows.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            types, helps = dict(self._types), dict(self._help)
+        for callback in self._callbacks:
+            try:
+                for name, kind, help_text, labels, value in callback():
+                    types.setdefault(name, kind)
+                    helps.setdefault(name, help_text)
+                    samples.setdefault(name, []).append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+            except Exception as e:
+                log.warning("Metrics callback failed: %s", e)
+        for name in sorted(samples):
+            lines.append(f"# HELP {name} {helps[name]}")
+            lines.append(f"# TYPE {name} {types[name]}")
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log.info("📈 Metrics available at http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+# === HTTP CLIENT ===
+def parse_host_pool_sizes(spec):
+    sizes = {}
+    for item in spec.split(","):
+        host, _, size = item.strip().partition("=")
+        if host and size.strip().isdigit():
+            sizes[host.strip().lower()] = int(size)
+    return sizes
+
+class Http2Response:
+    # Gives httpx responses the small slice of the requests.Response API the monitor uses,
+    # so callers keep catching requests.exceptions.RequestException either way.
+    def __init__(self, response, httpx_module):
+        self._response = response
+        self._httpx = httpx_module
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.encoding = response.encoding
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def json(self):
+        self._response.read()
+        return self._response.json()
+
+    def iter_content(self, chunk_size=None):
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except self._httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self._httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def close(self):
+        self._response.close()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+class HttpClient:
+    # One shared, pooled client for product fetches and Discord alerts so every check
+    # reuses warm keep-alive connections instead of paying a fresh TCP + TLS handshake.
+    def __init__(self, pool_size=HTTP_POOL_SIZE, host_pool_sizes=None, http2=HTTP2_ENABLED,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # Only advertise encodings urllib3 can actually decode (adds br when brotli is installed).
+        self.session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+        self.session.headers["Connection"] = "keep-alive"
+        default_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(1, pool_size))
+        self.session.mount("https://", default_adapter)
+        self.session.mount("http://", default_adapter)
+        if host_pool_sizes is None:
+            host_pool_sizes = parse_host_pool_sizes(HTTP_HOST_POOL_SIZES)
+        for host, size in host_pool_sizes.items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, size))
+            self.session.mount(f"https://{host}/", adapter)
+            self.session.mount(f"http://{host}/", adapter)
+
+        self.http2_client = None
+        if http2:
+            try:
+                import httpx
+                self.http2_client = httpx.Client(
+                    http2=True,
+                    headers=dict(self.session.headers),
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=httpx.Limits(max_connections=max(1, pool_size) * 4,
+                                        max_keepalive_connections=max(1, pool_size)),
+                )
+                self._httpx = httpx
+            except ImportError:
+                log.warning("⚠️ HTTP2_ENABLED is set but httpx[http2] is not installed. Falling back to HTTP/1.1.")
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if self.http2_client is None or kwargs.get("proxies"): # httpx only takes proxies per client
+            return self.session.request(method, url, **kwargs)
+        timeout = kwargs.pop("timeout")
+        if isinstance(timeout, tuple):
+            timeout = self._httpx.Timeout(timeout[1], connect=timeout[0])
+        stream = kwargs.pop("stream", False)
+        try:
+            request = self.http2_client.build_request(method, url, timeout=timeout, **kwargs)
+            return Http2Response(self.http2_client.send(request, stream=stream), self._httpx)
+        except self._httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except self._httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+        if self.http2_client is not None:
+            self.http2_client.close()
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HttpClient()
+    return _http_client
+
+# === FETCH GOVERNANCE ===
+class FetchFailure(requests.exceptions.RequestException):
+    # A fetch that says nothing about stock. `kind` is throttled (429), blocked (401/403),
+    # server_error (5xx), timeout, network, or circuit_open when the request was never sent.
+    def __init__(self, kind, message, retry_after=None, response=None):
+        super().__init__(message, response=response)
+        self.kind = kind
+        self.retry_after = retry_after
+
+BREAKER_FAILURES = ("throttled", "blocked", "server_error") # Kinds that say the host wants us to back off
+
+def classify_response(response):
+    status = response.status_code
+    if status == 429 or (status == 503 and response.headers.get("Retry-After")):
+        return "throttled"
+    if status in (401, 403):
+        return "blocked"
+    if status >= 500:
+        return "server_error"
+    return None
+
+class Identity:
+    # One request profile: a header set (User-Agent and friends) plus an optional egress proxy.
+    # `score` drifts toward 1.0 on success and drops on throttling, blocks and timeouts.
+    __slots__ = ("name", "headers", "proxies", "score", "requests", "failures")
+
+    def __init__(self, name, headers, proxy=None):
+        self.name = name
+        self.headers = headers
+        self.proxies = {"http": proxy, "https": proxy} if proxy else None
+        self.score = 1.0
+        self.requests = 0
+        self.failures = 0
+
+IDENTITY_PENALTIES = {"throttled": 0.5, "blocked": 0.3, "timeout": 0.8, "network": 0.8, "server_error": 0.9}
+
+def load_identity_profiles(path=None):
+    path = path or IDENTITY_PROFILES_PATH
+    if not path:
+        return DEFAULT_IDENTITY_PROFILES
+    with open(path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, list) or not all(isinstance(p, dict) and p.get("User-Agent") for p in profiles):
+        raise ValueError(f"{path}: expected a list of header objects, each with a User-Agent")
+    return profiles
+
+class IdentityPool:
+    # Every header profile paired with every egress proxy (or a direct connection).
+    # Picks are weighted by health score, so a throttled identity rests while the rest
+    # carry the load, and gets tried again as its score recovers.
+    MIN_WEIGHT = 0.05
+
+    def __init__(self, profiles=None, proxies=None, rng=None):
+        profiles = profiles if profiles is not None else load_identity_profiles()
+        if proxies is None:
+            proxies = [p.strip() for p in EGRESS_PROXIES.split(",") if p.strip()]
+        self.identities = [Identity(f"{i}@{urlparse(proxy).netloc if proxy else 'direct'}", dict(profile), proxy)
+                           for proxy in (proxies or [None]) for i, profile in enumerate(profiles)]
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            weights = [max(identity.score, self.MIN_WEIGHT) for identity in self.identities]
+            identity = self.rng.choices(self.identities, weights)[0]
+            identity.requests += 1
+            return identity
+
+    def report(self, identity, failure=None):
+        with self._lock:
+            if failure is None:
+                identity.score += (1.0 - identity.score) * 0.2
+            else:
+                identity.failures += 1
+                identity.score *= IDENTITY_PENALTIES.get(failure, 1.0)
+
+class HostHealth:
+    __slots__ = ("failures", "state", "open_until", "paused_until", "cooldown", "extra_delay")
+
+    def __init__(self):
+        self.failures = 0
+        self.state = "closed" # closed -> open after BREAKER_THRESHOLD failures -> half_open probe -> closed
+        self.open_until = 0.0
+        self.paused_until = 0.0 # Short Retry-After pauses; HostLimiter holds requests until then
+        self.cooldown = BREAKER_COOLDOWN
+        self.extra_delay = 0.0
+
+class FetchGovernor:
+    # Wraps every product fetch: picks an identity, keeps a circuit breaker per host, and
+    # classifies failures instead of letting them read as "out of stock". Throttling also
+    # widens the host's request spacing (HostLimiter adds extra_delay()), which shrinks
+    # again as requests succeed.
+    def __init__(self, identities=None, threshold=BREAKER_THRESHOLD, max_cooldown=BREAKER_MAX_COOLDOWN):
+        self.identities = identities or IdentityPool()
+        self.threshold = max(1, threshold)
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = HostHealth()
+        return health
+
+    def extra_delay(self, host):
+        health = self.hosts.get(host)
+        return health.extra_delay if health is not None else 0.0
+
+    def paused_until(self, host):
+        health = self.hosts.get(host)
+        return health.paused_until if health is not None else 0.0
+
+    def is_open(self, host, now=None):
+        # True while requests to host would be refused without being sent.
+        health = self.hosts.get(host)
+        if health is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return health.state == "half_open" or (health.state == "open" and now < health.open_until)
+
+    def _admit(self, host, now):
+        # Raises FetchFailure while the host's breaker is open; lets one probe through once it cools down.
+        with self._lock:
+            health = self._host(host)
+            if health.state == "closed":
+                return
+            if health.state == "open" and now >= health.open_until:
+                health.state = "half_open"
+                log.info("🔌 Circuit for %s half-open, sending a probe request.", host)
+                return
+            state, retry_in = health.state, max(0.0, health.open_until - now)
+        raise FetchFailure("circuit_open", f"circuit for {host} is {state}", retry_after=retry_in)
+
+    def record(self, host, failure=None, retry_after=None, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            health = self._host(host)
+            if failure is None:
+                if health.state != "closed":
+                    log.info("🔌 Circuit for %s closed again.", host)
+                health.state = "closed"
+                health.failures = 0
+                health.cooldown = BREAKER_COOLDOWN
+                health.extra_delay = health.extra_delay * 0.5 if health.extra_delay > 0.02 else 0.0
+                return
+            if failure not in BREAKER_FAILURES and health.state != "half_open":
+                return # Timeouts and connection errors only count against the identity, unless probing
+            health.failures += 1
+            if failure == "throttled" and not retry_after: # Without a Retry-After, find a slower pace ourselves
+                health.extra_delay = min(max(health.extra_delay * 2, THROTTLE_DELAY), THROTTLE_MAX_DELAY)
+            # A short Retry-After is waited out in HostLimiter; a long one opens the breaker for that long.
+            long_pause = retry_after is not None and retry_after > THROTTLE_MAX_DELAY
+            if retry_after and not long_pause:
+                health.paused_until = max(health.paused_until, now + retry_after)
+            if health.state != "half_open" and health.failures < self.threshold and not long_pause:
+                return
+            wait = max(health.cooldown, retry_after or 0.0)
+            if health.state != "open":
+                log.warning("🔌 Circuit for %s open for %.0fs after %s (%s failures in a row).",
+                            host, wait, failure, health.failures)
+                metrics.inc("restock_circuit_opened_total", help_text="Times a host's circuit breaker opened.",
+                            host=host, reason=failure)
+                health.cooldown = min(health.cooldown * 2, self.max_cooldown)
+            health.state = "open"
+            health.open_until = max(health.open_until, now + wait)
+
+    def get(self, url, headers=None, **kwargs):
+        # Returns the response for anything the caller can interpret (2xx, 304, 404, ...);
+        # raises FetchFailure for throttling, blocks, 5xx, timeouts and connection errors.
+        host = urlparse(url).netloc.lower()
+        self._admit(host, time.monotonic())
+        identity = self.identities.choose()
+        if identity.proxies:
+            kwargs.setdefault("proxies", identity.proxies)
+        try:
+            response = get_http_client().get(url, headers=dict(identity.headers, **(headers or {})), **kwargs)
+        except requests.exceptions.RequestException as e:
+            failure = "timeout" if isinstance(e, requests.exceptions.Timeout) else "network"
+            self.identities.report(identity, failure)
+            self.record(host, failure)
+            raise FetchFailure(failure, f"{type(e).__name__}: {e}") from e
+        failure = classify_response(response)
+        retry_after = None
+        if failure is not None:
+            try:
+                retry_after = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                pass
+        self.identities.report(identity, failure)
+        self.record(host, failure, retry_after)
+        if failure is not None:
+            response.close()
+            raise FetchFailure(failure, f"{host} answered {response.status_code}", retry_after, response)
+        return response
+
+    def stats(self):
+        # [(host, state, extra_delay)] and [(identity, score)] for /metrics.
+        with self._lock:
+            hosts = [(host, health.state, health.extra_delay) for host, health in self.hosts.items()]
+            identities = [(identity.name, identity.score) for identity in self.identities.identities]
+        return hosts, identities
+
+fetch_governor = FetchGovernor()
 
 def get_tcin_from_url(url_string):
     try:
@@ -39,498 +631,2599 @@ def get_tcin_from_url(url_string):
             if segment.startswith("A-") and len(segment) > 2 and segment[2:].isdigit():
                 return segment[2:]
     except Exception as e:
-        print(f"DEBUG: Error extracting TCIN from URL {url_string}: {e}")
+        log.debug("Error extracting TCIN from URL %s: %s", url_string, e)
     return None
 
-def is_in_stock(url):
-    tcin = get_tcin_from_url(url)
-    if not tcin:
-        print(f"DEBUG: Could not extract TCIN for URL: {url}. Marking as OOS.")
-        return False
-    print(f"DEBUG: Extracted TCIN {tcin} for URL {url}")
+# --- HTML Check for Add to Cart Button ---
+# These are common data-test attributes. You might need to adjust them
+# by inspecting the HTML of an in-stock item.
+ATC_BUTTON_SELECTORS = [
+    {"data-test": "addToCartButton"},
+    {"data-test": "shippingButton"}
+    # Add more selectors if Target uses others for the main purchase button
+]
+TGT_DATA_MARKER = "__TGT_DATA__"
+PDP_QUERY_NAME = "@web/domain-product/get-pdp-v1"
+PDP_DECODE_WINDOW = 64 * 1024 # Initial chars to unescape when selectively decoding the pdp entry
+
+# What the stock decision needs from a product page: for each ATC selector that matched a
+# <button>, whether that button is disabled (in selector order), plus the __TGT_DATA__ script text.
+PageParts = namedtuple("PageParts", ["buttons", "tgt_script"])
 
+_TGT_DATA_RE = re.compile(
+    r"['\"]__TGT_DATA__['\"]\s*:\s*\{\s*configurable:\s*false,\s*enumerable:\s*true,\s*value:\s*deepFreeze\(JSON\.parse\((.*?)\)\),\s*writable:\s*false\s*\}",
+    re.DOTALL
+)
+# Start of a [[name, params], result] query entry for the pdp query inside the escaped JSON.parse literal.
+_PDP_ENTRY_RE = re.compile(r'\[\s*\[\s*\\?"' + re.escape(PDP_QUERY_NAME) + r'\\?"')
+_JSON_DECODER = json.JSONDecoder()
+_TAG_NAME_RE = re.compile(rb"<([a-zA-Z][a-zA-Z0-9:-]*)")
+_TAG_ATTR_RE = re.compile(rb"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?""")
+
+def _find_button_tag(body, attr_name, attr_value, start=0):
+    # Returns the raw attributes of the first <button> whose attr_name equals attr_value,
+    # False if the value never appears inside a <button> tag, or None if the markup around
+    # an occurrence could not be understood (caller falls back to BeautifulSoup).
+    needle = attr_value.encode()
+    pos = body.find(needle, start)
+    while pos != -1:
+        tag_start = body.rfind(b"<", 0, pos)
+        if tag_start != -1 and body.find(b">", tag_start, pos) == -1:
+            name_match = _TAG_NAME_RE.match(body, tag_start)
+            if name_match and name_match.group(1).lower() == b"button":
+                tag_end = body.find(b">", pos)
+                if tag_end == -1:
+                    return None
+                attrs = {}
+                for attr in _TAG_ATTR_RE.finditer(body, name_match.end(), tag_end):
+                    key = attr.group(1).lower()
+                    if key not in attrs:
+                        value = attr.group(2) if attr.group(2) is not None else attr.group(3) if attr.group(3) is not None else attr.group(4)
+                        attrs[key] = value if value is not None else b""
+                if attrs.get(attr_name.encode()) == needle:
+                    return attrs
+        pos = body.find(needle, pos + len(needle))
+    return False
+
+def _find_tgt_script(body, encoding):
+    # Returns the text of the first <script> containing __TGT_DATA__, or None if the markup
+    # around the marker could not be understood (caller falls back to BeautifulSoup).
+    needle = TGT_DATA_MARKER.encode()
+    pos = body.find(needle)
+    while pos != -1:
+        script_start = body.rfind(b"<script", 0, pos)
+        if script_start != -1 and body.find(b"</script", script_start, pos) == -1:
+            content_start = body.find(b">", script_start, pos)
+            content_end = body.find(b"</script", pos)
+            if content_start == -1 or content_end == -1:
+                return None
+            return body[content_start + 1:content_end].decode(encoding, errors="replace")
+        pos = body.find(needle, pos + len(needle))
+    return None
+
+def extract_page_parts(body, encoding="utf-8"):
+    # Fast path: scan the raw bytes for just the ATC buttons and the __TGT_DATA__ script
+    # instead of building a full parse tree. Returns None when it can't be sure of the answer.
+    buttons = []
+    with metrics.stage("html_parse"):
+        for selector in ATC_BUTTON_SELECTORS:
+            for attr_name, attr_value in selector.items():
+                attrs = _find_button_tag(body, attr_name, attr_value)
+                if attrs is None:
+                    return None
+                if attrs is not False:
+                    buttons.append((selector, b"disabled" in attrs))
+
+    tgt_script = None
+    with metrics.stage("script_extraction"):
+        if TGT_DATA_MARKER.encode() in body:
+            tgt_script = _find_tgt_script(body, encoding)
+            if tgt_script is None:
+                return None
+    return PageParts(buttons, tgt_script)
+
+class PageScanner:
+    # Incremental companion to extract_page_parts() for streamed bodies. feed() reports when
+    # everything the verdict depends on has arrived: the complete __TGT_DATA__ script plus
+    # either an active ATC button or the first button for every selector. Bytes after that
+    # point can't change the verdict, so the rest of the download can be skipped.
+    def __init__(self):
+        self.body = bytearray()
+        self.complete = False
+        self._needles = [(index, attr_name, attr_value)
+                         for index, selector in enumerate(ATC_BUTTON_SELECTORS) for attr_name, attr_value in selector.items()]
+        self._buttons = {} # needle index -> disabled
+        self._button_from = [0] * len(self._needles) # Where each needle's unexamined bytes start
+        self._script_found = False
+        self._marker_at = None
+        self._marker_from = 0
+        self._script_end_from = 0
+
+    def feed(self, chunk):
+        self.body += chunk
+        if not self.complete:
+            self.complete = self._scan()
+        return self.complete
+
+    def _scan(self):
+        body = self.body
+        if not self._script_found:
+            marker = TGT_DATA_MARKER.encode()
+            if self._marker_at is None:
+                pos = body.find(marker, self._marker_from)
+                if pos == -1:
+                    self._marker_from = max(0, len(body) - len(marker) + 1)
+                else:
+                    self._marker_at = self._script_end_from = pos
+            if self._marker_at is not None:
+                if body.find(b"</script", self._script_end_from) == -1:
+                    self._script_end_from = max(self._marker_at, len(body) - len(b"</script") + 1)
+                elif _find_tgt_script(body, "utf-8") is not None:
+                    self._script_found = True
+                else: # That marker wasn't inside a script; look for the next one
+                    self._marker_from, self._marker_at = self._marker_at + len(marker), None
+        for i, (_, attr_name, attr_value) in enumerate(self._needles):
+            if i not in self._buttons:
+                attrs = _find_button_tag(body, attr_name, attr_value, self._button_from[i])
+                if attrs is False: # No button yet; only bytes that could still complete the needle need another look
+                    self._button_from[i] = max(0, len(body) - len(attr_value) + 1)
+                elif attrs: # None means the tag is still arriving
+                    self._buttons[i] = b"disabled" in attrs
+        if not self._script_found:
+            return False
+        return len(self._buttons) == len(self._needles) or any(not disabled for disabled in self._buttons.values())
+
+def read_product_page(response):
+    # Streams a product page through a PageScanner and stops once it is complete. Raises
+    # FetchFailure("too_large") past MAX_BODY_BYTES rather than judge a truncated page.
+    scanner = PageScanner()
+    stopped_early = False
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        if scanner.feed(chunk):
+            stopped_early = True
+            break
+        if len(scanner.body) > MAX_BODY_BYTES:
+            raise FetchFailure("too_large", f"body exceeded {MAX_BODY_BYTES} bytes")
+    metrics.inc("restock_body_bytes_total", len(scanner.body), help_text="Product page bytes read.")
+    if stopped_early:
+        metrics.inc("restock_streams_stopped_early_total", help_text="Page downloads ended once the verdict inputs arrived.")
+        _drain_if_short(response)
+    return bytes(scanner.body)
+
+def _drain_if_short(response):
+    # Closing a half-read HTTP/1.1 response drops its connection. When little is left it's
+    # cheaper to finish the read and keep the connection warm than to handshake again.
+    raw = getattr(response, "raw", None)
     try:
-        print(f"DEBUG: Fetching URL: {url}")
-        response = requests.get(url, headers=HEADERS, timeout=20)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # --- Save HTML for debugging (can be commented out once stable) ---
-        # try:
-        #     product_id_for_filename = tcin
-        #     safe_product_id_part = "".join(c if c.isalnum() or c in ['-', '_'] else '_' for c in product_id_for_filename)
-        #     filename = f"debug_target_page_A-{safe_product_id_part}.html"
-        #     with open(filename, "w", encoding="utf-8") as f:
-        #         f.write(soup.prettify())
-        # except Exception as e:
-        #     print(f"DEBUG: Could not save HTML to file for {url}: {e}")
-        # --- End Save HTML ---
-
-        # --- HTML Check for Add to Cart Button ---
-        # These are common data-test attributes. You might need to adjust them
-        # by inspecting the HTML of an in-stock item.
-        possible_atc_button_selectors = [
-            {"data-test": "addToCartButton"},
-            {"data-test": "shippingButton"} 
-            # Add more selectors if Target uses others for the main purchase button
-        ]
-        
-        found_active_atc_button_in_html = False
-        atc_button_details = "No primary ATC button found in HTML"
+        remaining = int(response.headers.get("Content-Length")) - raw.tell()
+    except (TypeError, ValueError, AttributeError):
+        return
+    if 0 < remaining <= STREAM_DRAIN_BYTES:
+        for _ in response.iter_content(STREAM_CHUNK_SIZE):
+            pass
 
-        for selector in possible_atc_button_selectors:
+def extract_page_parts_with_soup(body, encoding="utf-8"):
+    metrics.inc("restock_soup_fallbacks_total", help_text="Pages the fast-path extractor handed to BeautifulSoup.")
+    with metrics.stage("html_parse"):
+        soup = BeautifulSoup(body.decode(encoding, errors="replace"), "html.parser")
+        buttons = []
+        for selector in ATC_BUTTON_SELECTORS:
             button = soup.find("button", attrs=selector)
             if button:
-                selector_str = ", ".join([f"{k}='{v}'" for k,v in selector.items()])
-                if 'disabled' in button.attrs:
-                    atc_button_details = f"Button {selector_str} found but DISABLED in HTML."
-                    print(f"DEBUG: TCIN {tcin} - {atc_button_details}")
-                    # If a primary button is found and explicitly disabled, likely OOS for that method
-                    # For now, we'll let JSON confirm, but this is a strong negative signal.
-                else:
-                    atc_button_details = f"Button {selector_str} found and ACTIVE in HTML."
-                    print(f"DEBUG: TCIN {tcin} - {atc_button_details}")
-                    found_active_atc_button_in_html = True
-                    break # Found an active button
-            # else:
-                # print(f"DEBUG: TCIN {tcin} - Button with selector {selector} NOT found in HTML.")
-        
-        # If no active primary purchase button is found in the initial HTML,
-        # it's a strong indicator of OOS, especially for shippable items.
-        if not found_active_atc_button_in_html:
-            print(f"DEBUG: TCIN {tcin} - No clearly active 'Add to Cart' or 'Shipping' button found in initial HTML. Details: {atc_button_details}. Marking OOS.")
-            return False
-        
-        # --- JSON Verification (If HTML check passed) ---
-        print(f"DEBUG: TCIN {tcin} - Active button found in HTML, proceeding to JSON verification.")
-        script_tag = soup.find("script", string=lambda t: t and "__TGT_DATA__" in t)
-        if not script_tag or not script_tag.string:
-            print(f"DEBUG: TCIN {tcin} - __TGT_DATA__ script tag not found or empty. Marking as OOS despite HTML button.")
-            return False
+                buttons.append((selector, 'disabled' in button.attrs))
+    with metrics.stage("script_extraction"):
+        script_tag = soup.find("script", string=lambda t: t and TGT_DATA_MARKER in t)
+    return PageParts(buttons, script_tag.string if script_tag else None)
 
-        content = script_tag.string
-        json_str = None
-        match = re.search(
-            r"['\"]__TGT_DATA__['\"]\s*:\s*\{\s*configurable:\s*false,\s*enumerable:\s*true,\s*value:\s*deepFreeze\(JSON\.parse\((.*?)\)\),\s*writable:\s*false\s*\}",
-            content, re.DOTALL
-        )
-        if match:
-            json_arg_str = match.group(1).strip()
-            if (json_arg_str.startswith('"') and json_arg_str.endswith('"')) or \
-               (json_arg_str.startswith("'") and json_arg_str.endswith("'")):
-                json_str = json_arg_str[1:-1]
-                try:
-                    json_str = json_str.encode('latin-1', 'backslashreplace').decode('unicode-escape')
-                except Exception as e:
-                    print(f"DEBUG: Error during unicode_escape of JSON string for {url}: {e}")
-                    return False # Error during parsing
-            else: # Should not happen if regex is correct and HTML structure is as expected
-                print(f"DEBUG: Captured JSON argument for __TGT_DATA__ is not correctly quoted: {json_arg_str[:100]}...")
-                return False
-        else:
-            print(f"DEBUG: Could not regex parse the JSON block from __TGT_DATA__ for {url}.")
-            return False
-        
-        if not json_str:
-            print(f"DEBUG: Could not extract JSON string from __TGT_DATA__ for {url}. Marking as OOS.")
-            return False
+# === CHANGE DETECTION ===
+# Boundary between two query entries in the escaped __TGT_DATA__ literal: ...],[["@web/...
+_NEXT_QUERY_ENTRY_RE = re.compile(r'\]\s*,\s*\[\s*\[\s*\\?"@web/')
 
-        try:
-            data = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"DEBUG: Failed to decode JSON from __TGT_DATA__ for {url}: {e}. Snippet: {json_str[:1000]}")
-            return False
+def utc_day():
+    # A pre-order verdict can change with the calendar while the page stays byte-for-byte the
+    # same, so anything reused across checks is only trusted on the UTC day it was made.
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-        product_data_from_json = None
-        if data.get("__PRELOADED_QUERIES__") and data["__PRELOADED_QUERIES__"].get("queries"):
-            for query_entry in data["__PRELOADED_QUERIES__"]["queries"]:
-                if isinstance(query_entry, list) and len(query_entry) == 2:
-                    query_details, query_result = query_entry[0], query_entry[1]
-                    if isinstance(query_details, list) and len(query_details) == 2:
-                        query_name, query_params = query_details[0], query_details[1]
-                        if query_name == "@web/domain-product/get-pdp-v1" and isinstance(query_params, dict) and query_params.get("tcin") == tcin:
-                            if query_result and query_result.get("data") and query_result["data"].get("product"):
-                                product_data_from_json = query_result["data"]["product"]
-                                break
-        
-        if not product_data_from_json:
-            print(f"DEBUG: Product data for TCIN {tcin} not found in __TGT_DATA__ JSON. Marking OOS.")
-            return False
+def page_fingerprint(parts):
+    # Cheap digest of just the regions the verdict depends on: the ATC button states and the
+    # pdp query slice(s) of __TGT_DATA__, plus today's date (see utc_day).
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(utc_day().encode())
+    digest.update(repr(parts.buttons).encode())
+    script = parts.tgt_script
+    if script:
+        found_entry = False
+        for entry in _PDP_ENTRY_RE.finditer(script):
+            found_entry = True
+            next_entry = _NEXT_QUERY_ENTRY_RE.search(script, entry.end())
+            digest.update(script[entry.start():next_entry.start() if next_entry else len(script)].encode("utf-8", "surrogatepass"))
+        if not found_entry: # Unusual payload layout: fingerprint the whole script to stay safe
+            digest.update(script.encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
 
-        # Pre-order Check
-        street_date_str = product_data_from_json.get("item", {}).get("mmbv_content", {}).get("street_date")
-        if street_date_str:
-            try:
-                street_date = datetime.strptime(street_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                current_date = datetime.now(timezone.utc)
-                if street_date > current_date:
-                    print(f"DEBUG: TCIN {tcin} - Pre-order (Street Date: {street_date_str}). Marking OOS.")
-                    return False
-            except ValueError:
-                print(f"DEBUG: TCIN {tcin} - Could not parse street_date: {street_date_str}")
-
-        # JSON based checks for shipping
-        is_product_purchasable_json = product_data_from_json.get("purchasable")
-        
-        online_channel_eligible_json = False
-        online_channel_reason_json = "UNKNOWN"
-        purchasing_channels = product_data_from_json.get("item", {}).get("fulfillment", {}).get("purchasing_channel_eligibility", [])
-        for channel_info in purchasing_channels:
-            if isinstance(channel_info, dict) and channel_info.get("channel") == "ONLINE":
-                online_channel_eligible_json = channel_info.get("is_eligible", False)
-                online_channel_reason_json = str(channel_info.get("reason", "UNKNOWN")).upper()
-                break
-        
-        shipping_options_data = product_data_from_json.get("item", {}).get("fulfillment", {}).get("shipping_options", {})
-        if not isinstance(shipping_options_data, dict): shipping_options_data = {}
-        shipping_order_limit_json = shipping_options_data.get("order_limit", -1)
-        
-        print(f"DEBUG: TCIN {tcin} - JSON - Purchasable: {is_product_purchasable_json}, OnlineChannelEligible: {online_channel_eligible_json}, OnlineChannelReason: '{online_channel_reason_json}', ShipLimit: {shipping_order_limit_json}")
-
-        if is_product_purchasable_json is False:
-            print(f"DEBUG: TCIN {tcin} - JSON 'purchasable' is False. Marking OOS.")
-            return False
+class ChangeDetector:
+    # Per-product memory of the last response validators (ETag / Last-Modified), the last
+    # content fingerprint and the verdict it produced. Unchanged pages skip decode + decision.
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.fingerprint_hits = 0
+        self.fingerprint_misses = 0
+        self.not_modified = 0
 
-        positive_online_reasons = ["AVAILABLE", "IN_STOCK", "PREORDER_SELLABLE"]
-        if online_channel_eligible_json and online_channel_reason_json in positive_online_reasons:
-            if shipping_order_limit_json == 0:
-                 print(f"DEBUG: TCIN {tcin} - JSON Online channel OK ('{online_channel_reason_json}') but shipping_order_limit is 0. Marking OOS.")
-                 return False
-            print(f"DEBUG: TCIN {tcin} - JSON Online channel eligible and reason '{online_channel_reason_json}' is positive. Marking IN STOCK.")
-            return True
-        
-        print(f"DEBUG: TCIN {tcin} - JSON checks did not confirm shippable stock. OnlineChannelEligible: {online_channel_eligible_json} (Reason: '{online_channel_reason_json}'). Marking OOS.")
-        return False
+    def conditional_headers(self, key):
+        # Only ask for a 304 when we still hold the verdict to reuse and the validators were
+        # taken today: a page unchanged since yesterday may still decide differently today.
+        entry = self._entries.get(key)
+        headers = {}
+        if entry and entry.get("result") is not None and entry.get("day") == utc_day():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error checking {url}: RequestException - {e}")
-        return False
-    except Exception as e:
-        print(f"An unexpected error occurred in is_in_stock for {url}: {e}")
-        import traceback
-        traceback.print_exc() 
-        return False
+    def remember_validators(self, key, response):
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            entry["etag"] = response.headers.get("ETag")
+            entry["last_modified"] = response.headers.get("Last-Modified")
+            entry["day"] = utc_day()
 
-def send_discord_alert(product_name, url):
-    if not DISCORD_WEBHOOK_URL:
-        print("🚨 DISCORD_WEBHOOK_URL is not set. Cannot send alert.")
-        return
-    data = {
-        "content": f"🔔 **{product_name} is back in stock!**\n{url}",
-        "username": "Target Restock Bot"
-    }
+    def known_fingerprint(self, key):
+        entry = self._entries.get(key)
+        return entry.get("fingerprint") if entry and entry.get("result") is not None else None
+
+    def cached_result(self, key):
+        # Verdict to reuse after a 304 Not Modified; None if it was decided on an earlier UTC day.
+        entry = self._entries.get(key)
+        with self._lock:
+            self.not_modified += 1
+        return entry.get("result") if entry and entry.get("day") == utc_day() else None
+
+    def lookup(self, key, fingerprint):
+        entry = self._entries.get(key)
+        with self._lock:
+            if entry and entry.get("fingerprint") == fingerprint and entry.get("result") is not None:
+                self.fingerprint_hits += 1
+                return entry["result"]
+            self.fingerprint_misses += 1
+        return None
+
+    def store(self, key, fingerprint, result):
+        with self._lock:
+            entry = self._entries.setdefault(key, {})
+            entry["fingerprint"] = fingerprint
+            entry["result"] = result
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {
+            "fingerprint_hits": self.fingerprint_hits,
+            "fingerprint_misses": self.fingerprint_misses,
+            "not_modified": self.not_modified,
+        }
+
+change_detector = ChangeDetector()
+
+# Outcome of one product check: the verdict plus the decision signals from the product JSON
+# (None when the check never got as far as the JSON). A check that failed has in_stock=None
+# ("unknown") and the failure kind, so it never reads as out of stock. `rule` names the
+# availability rule (or page check) that decided the verdict.
+CheckResult = namedtuple("CheckResult", ["in_stock", "signals", "failure", "rule"], defaults=(None, None))
+
+def is_in_stock(url):
+    return check_product(url).in_stock
+
+def check_product(url, tcin=None):
+    tcin = tcin or get_tcin_from_url(url)
+    if not tcin:
+        log.debug("Could not extract TCIN for URL: %s. Marking as OOS.", url)
+        return CheckResult(False, None)
+    log.debug("Extracted TCIN %s for URL %s", tcin, url)
+
+    started = time.perf_counter()
     try:
-        response = requests.post(DISCORD_WEBHOOK_URL, json=data, timeout=10)
-        response.raise_for_status()
-        print(f"✅ Alert sent for {product_name}: {response.status_code}")
+        log.debug("Fetching URL: %s", url)
+        with metrics.stage("fetch"):
+            response = fetch_governor.get(url, headers=change_detector.conditional_headers(tcin), stream=STREAM_FETCH)
+            if response.status_code == 304:
+                response.close()
+                cached = change_detector.cached_result(tcin)
+                if cached is not None:
+                    log.debug("TCIN %s - 304 Not Modified, reusing last verdict.", tcin)
+                    if capture_archive is not None:
+                        capture_archive.record(tcin, url, 304, elapsed=time.perf_counter() - started)
+                    return cached
+                change_detector.forget(tcin) # Nothing to reuse; refetch unconditionally
+                response = fetch_governor.get(url, stream=STREAM_FETCH)
+            try:
+                response.raise_for_status()
+                body = read_product_page(response) if STREAM_FETCH else response.content
+            finally:
+                response.close()
+        change_detector.remember_validators(tcin, response)
+        if capture_archive is not None:
+            capture_archive.record(tcin, url, response.status_code, response.encoding, body, time.perf_counter() - started)
+
+        return analyze_page(tcin, body, response.encoding or "utf-8", url)
+    except FetchFailure as e:
+        log.warning("⚠️ Could not check %s (%s): %s. Verdict unknown.", url, e.kind, e)
+        metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type=e.kind)
+        if capture_archive is not None:
+            capture_archive.record(tcin, url, elapsed=time.perf_counter() - started, failure=e.kind)
+        return CheckResult(None, None, e.kind)
     except requests.exceptions.RequestException as e:
-        print(f"🚨 Failed to send Discord alert for {product_name}: {e}")
+        log.error("Error checking %s: RequestException - %s", url, e)
+        metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type=type(e).__name__)
+        if capture_archive is not None:
+            capture_archive.record(tcin, url, elapsed=time.perf_counter() - started, failure=type(e).__name__)
+        return CheckResult(None, None, type(e).__name__)
     except Exception as e:
-        print(f"🚨 An unexpected error occurred while sending Discord alert: {e}")
+        log.exception("An unexpected error occurred in is_in_stock for %s: %s", url, e)
+        metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type=type(e).__name__)
+        return CheckResult(None, None, type(e).__name__)
 
-def main():
-    if not DISCORD_WEBHOOK_URL:
-        print("⚠️ DISCORD_WEBHOOK_URL environment variable not found. Alerts will not be sent.")
+def analyze_page(tcin, body, encoding="utf-8", url=None):
+    url = url or f"TCIN {tcin}"
+    if PARSE_WORKERS > 0:
+        return analyze_page_in_pool(tcin, body, encoding, url)
+
+    parts = extract_page_parts(body, encoding)
+    if parts is None:
+        log.debug("TCIN %s - Fast-path extractor could not read the page markup. Falling back to BeautifulSoup.", tcin)
+        parts = extract_page_parts_with_soup(body, encoding)
+
+    with metrics.stage("fingerprint"):
+        fingerprint = page_fingerprint(parts)
+    cached = change_detector.lookup(tcin, fingerprint)
+    if cached is not None:
+        log.debug("TCIN %s - Page fingerprint unchanged, reusing last verdict.", tcin)
+        return cached
+    result = decide_page(tcin, parts, url)
+    change_detector.store(tcin, fingerprint, result)
+    return result
 
-    print("🛒 Starting Target product restock monitor...")
-    print(f"Checking {len(PRODUCTS)} products every {CHECK_INTERVAL} seconds.")
+# === PARSER PROCESS POOL ===
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def _init_parse_worker(log_level):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s [parser %(process)d] %(message)s")
+
+def get_parse_pool():
+    global _parse_pool
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                # spawn, not fork: the parent is multi-threaded by the time the pool starts.
+                _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=_init_parse_worker, initargs=(LOG_LEVEL,))
+    return _parse_pool
+
+def shutdown_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+
+def recycle_parse_pool(pool):
+    # cancel() can't stop a parse that is already running, so a page that timed out would
+    # keep its process busy for good. Retire the pool and terminate its processes; the
+    # next check builds a fresh one.
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    for process in list((getattr(pool, "_processes", None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_page_record(tcin, body, encoding, url, known_fingerprint=None):
+    # Runs in a parser process. Returns a compact (fingerprint, CheckResult, seconds) record;
+    # the result is None when the page fingerprint matches known_fingerprint, so unchanged
+    # pages skip the decode and nothing but the digest travels back.
+    started = time.perf_counter()
+    parts = extract_page_parts(body, encoding)
+    if parts is None:
+        parts = extract_page_parts_with_soup(body, encoding)
+    fingerprint = page_fingerprint(parts)
+    if fingerprint == known_fingerprint:
+        return fingerprint, None, time.perf_counter() - started
+    return fingerprint, decide_page(tcin, parts, url), time.perf_counter() - started
+
+def _parse_in_pool(tcin, *args):
+    # Returns parse_page_record's record, or None if the parse took longer than PARSE_TIMEOUT
+    # (the pool is then recycled). A check caught in a pool another check just recycled is
+    # retried once on the new pool.
+    for attempt in range(2):
+        pool = get_parse_pool()
+        try:
+            return pool.submit(parse_page_record, tcin, *args).result(timeout=PARSE_TIMEOUT)
+        except FuturesTimeoutError:
+            log.error("TCIN %s - Parsing took longer than %ss, giving up on this check and restarting the parser pool.",
+                      tcin, PARSE_TIMEOUT)
+            metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type="parse_timeout")
+            recycle_parse_pool(pool)
+            return None
+        except BrokenProcessPool:
+            if attempt:
+                raise
+
+def analyze_page_in_pool(tcin, body, encoding, url):
+    # The fetch thread hands the raw bytes to a parser process and waits at most PARSE_TIMEOUT,
+    # so one pathological page costs its own check (an unknown verdict), not everyone else's.
+    record = _parse_in_pool(tcin, body, encoding, url, change_detector.known_fingerprint(tcin))
+    if record is None:
+        return CheckResult(None, None, "parse_timeout")
+    fingerprint, result, elapsed = record
+    metrics.observe("restock_stage_seconds", elapsed, help_text="Time spent in each stage of a product check.", stage="parse_worker")
+    if result is None:
+        cached = change_detector.lookup(tcin, fingerprint)
+        if cached is not None:
+            log.debug("TCIN %s - Page fingerprint unchanged, reusing last verdict.", tcin)
+            return cached
+        # The cached verdict vanished while the page was being parsed; parse it in full.
+        record = _parse_in_pool(tcin, body, encoding, url)
+        if record is None:
+            return CheckResult(None, None, "parse_timeout")
+        fingerprint, result, _ = record
+    else:
+        change_detector.lookup(tcin, fingerprint) # Counts the miss
+    change_detector.store(tcin, fingerprint, result)
+    return result
+
+def decide_page(tcin, parts, url):
+    found_active_atc_button_in_html = False
+    atc_button_details = "No primary ATC button found in HTML"
+
+    for selector, disabled in parts.buttons:
+        selector_str = ", ".join([f"{k}='{v}'" for k,v in selector.items()])
+        if disabled:
+            atc_button_details = f"Button {selector_str} found but DISABLED in HTML."
+            log.debug("TCIN %s - %s", tcin, atc_button_details)
+            # If a primary button is found and explicitly disabled, likely OOS for that method
+            # For now, we'll let JSON confirm, but this is a strong negative signal.
+        else:
+            atc_button_details = f"Button {selector_str} found and ACTIVE in HTML."
+            log.debug("TCIN %s - %s", tcin, atc_button_details)
+            found_active_atc_button_in_html = True
+            break # Found an active button
+
+    # The JSON signals are decoded even when the button check already says OOS, so the
+    # scheduler can see a product moving toward availability before the button flips.
+    with metrics.stage("json_decode"):
+        product_data_from_json = find_pdp_product(tcin, parts.tgt_script, url) if parts.tgt_script else None
+        signals = pdp_signals(product_data_from_json) if product_data_from_json else None
+    
+    # If no active primary purchase button is found in the initial HTML,
+    # it's a strong indicator of OOS, especially for shippable items.
+    if not found_active_atc_button_in_html:
+        log.debug("TCIN %s - No clearly active 'Add to Cart' or 'Shipping' button found in initial HTML. Details: %s. Marking OOS.", tcin, atc_button_details)
+        return CheckResult(False, signals, rule="no_active_button")
     
-    while True:
-        for name, url in PRODUCTS.items():
+    # --- JSON Verification (If HTML check passed) ---
+    log.debug("TCIN %s - Active button found in HTML, proceeding to JSON verification.", tcin)
+    if not parts.tgt_script:
+        log.debug("TCIN %s - __TGT_DATA__ script tag not found or empty. Marking as OOS despite HTML button.", tcin)
+        return CheckResult(False, None, rule="no_page_data")
+
+    if product_data_from_json is None:
+        return CheckResult(False, None, rule="no_page_data")
+    if not product_data_from_json:
+        log.debug("Product data for TCIN %s not found in __TGT_DATA__ JSON. Marking OOS.", tcin)
+        return CheckResult(False, None, rule="no_product_data")
+
+    with metrics.stage("decision"):
+        in_stock, rule = decide_stock(tcin, signals)
+    return CheckResult(in_stock, signals, rule=rule)
+
+def _decode_pdp_entry(content, start, end, tcin):
+    # Selective decode: unescape and json-decode only the get-pdp-v1 query entry for this TCIN,
+    # growing the window until the entry parses. Returns None if no entry could be decoded
+    # this way, in which case the caller falls back to decoding the whole payload.
+    for entry in _PDP_ENTRY_RE.finditer(content, start, end):
+        window = PDP_DECODE_WINDOW
+        while True:
+            stop = min(end, entry.start() + window)
             try:
-                print(f"🔍 Checking: {name} ({url})")
-                in_stock_status = is_in_stock(url)
-                
-                if in_stock_status:
-                    if name not in alerted_items:
-                        print(f"✅ {name} IN STOCK! Sending alert...")
-                        send_discord_alert(name, url)
-                        alerted_items.add(name)
-                    else:
-                        print(f"ℹ️ {name} is in stock but already alerted.")
-                else:
-                    print(f"❌ {name} is out of stock.")
-                    if name in alerted_items:
-                        print(f"🗑️ Resetting alert status for {name} as it's now OOS.")
-                        alerted_items.discard(name)
-            except Exception as e:
-                print(f"⚠️ An unexpected error occurred in main loop for {name}: {e}")
-            
-            time.sleep(3) 
+                chunk = content[entry.start():stop].encode('latin-1', 'backslashreplace').decode('unicode-escape')
+                query_entry, _ = _JSON_DECODER.raw_decode(chunk)
+                break
+            except (UnicodeDecodeError, ValueError): # Window cut the entry (or an escape) short
+                if stop >= end:
+                    return None
+                window *= 4
+        if isinstance(query_entry, list) and len(query_entry) == 2:
+            query_details, query_result = query_entry[0], query_entry[1]
+            if isinstance(query_details, list) and len(query_details) == 2:
+                query_params = query_details[1]
+                if isinstance(query_params, dict) and query_params.get("tcin") == tcin:
+                    if query_result and query_result.get("data") and query_result["data"].get("product"):
+                        return query_result["data"]["product"]
+    return None
 
-        print(f"--- Loop finished, sleeping for {CHECK_INTERVAL} seconds ---")
-        time.sleep(CHECK_INTERVAL)
+def find_pdp_product(tcin, content, url):
+    # Returns the get-pdp-v1 product dict for the TCIN, {} if the payload has none,
+    # or None if the __TGT_DATA__ block itself could not be parsed.
+    match = _TGT_DATA_RE.search(content)
+    if not match:
+        log.debug("Could not regex parse the JSON block from __TGT_DATA__ for %s.", url)
+        return None
 
-if __name__ == "__main__":
-    if not PRODUCTS:
-        print("🚫 No products configured in the PRODUCTS dictionary. Exiting.")
-    else:
-        main()
-import requests
-from bs4 import BeautifulSoup
-import time
-import os
-import json # For parsing JSON data
-import re   # For regular expressions
-from urllib.parse import urlparse # For parsing URLs and robust filename generation
-from datetime import datetime, timezone # For checking pre-order street dates
+    # Work on offsets into the script text rather than copying the (multi-megabyte) literal.
+    start, end = match.span(1)
+    while start < end and content[start].isspace():
+        start += 1
+    while end > start and content[end - 1].isspace():
+        end -= 1
+    quote = content[start] if start < end else ""
+    if quote not in ('"', "'") or end - start < 2 or content[end - 1] != quote:
+        # Should not happen if regex is correct and HTML structure is as expected
+        log.debug("Captured JSON argument for __TGT_DATA__ is not correctly quoted: %s...", content[start:start + 100])
+        return None
+    start, end = start + 1, end - 1
 
-# === CONFIG ===
-PRODUCTS = {
-    "Prismatic Mystery": "https://www.target.com/p/-/A-94336414",
-    "Surging Sparks Booster Box": "https://www.target.com/p/pok--233-mon-scarlet-violet-surging-sparks-booster-trading-cards/-/A-93486336",
-    "Destined Rivals 3 Pack": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212--destined-rivals-three-booster-blister-zebstrika/-/A-94300073",
-    "Prismatic Sticker Collection": "https://www.target.com/p/2025-pokemon-prismatic-evolutions-tech-sticker-collection-dw-sylveon/-/A-94300058",
-    "Prismatic ETB": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212-prismatic-evolutions-elite-trainer-box--no-aasa/-/A-93954435",
-    "Prismatic Poster Collection": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212-prismatic-evolutions-poster-collection--no-aasa/-/A-93803457",
-    "Prismatic Bundle": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212-prismatic-evolutions-booster-bundle--no-aasa/-/A-93954446",
-    "Prismatic SPC": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212-prismatic-evolutions-super-premium-collection--no-aasa/-/A-94300072",
-    "Prismatic Binder": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212-prismatic-evolutions-binder-collection--no-aasa/-/A-94300066",
-    "DR Bundle": "https://www.target.com/p/pok--233-mon-trading-card-game--scarlet---38--violet--8212--destined-rivals-booster-bundle--no-aasa/-/A-94300067",
-    "Crown Zenith Bundle": "https://www.target.com/p/pok--233-mon-trading-card-game--crown-zenith-booster-bundle-box--no-aasa/-/A-94091405",
-    "Lego Minecraft": "https://www.target.com/p/lego-minecraft-the-lush-cave-fight-building-toy-30705/-/A-93104070#lnk=sametab",
-    "April 2025 Zard Box": "https://www.target.com/p/2025-pokemon-april-special-collectible-trading-cards/-/A-94411686?preselect=94411686",
-    "SV 3.5 151 Booster Bundle Box": "https://www.target.com/p/pokemon-scarlet-violet-s3-5-booster-bundle-box/-/A-88897904?preselect=88897904"
+    product = _decode_pdp_entry(content, start, end, tcin)
+    if product is not None:
+        return product
+
+    # Slow path: decode the whole payload and walk __PRELOADED_QUERIES__.
+    log.debug("TCIN %s - Selective decode found no pdp entry, decoding full __TGT_DATA__ payload.", tcin)
+    try:
+        json_str = content[start:end].encode('latin-1', 'backslashreplace').decode('unicode-escape')
+    except Exception as e:
+        log.debug("Error during unicode_escape of JSON string for %s: %s", url, e)
+        return None # Error during parsing
+    if not json_str:
+        log.debug("Could not extract JSON string from __TGT_DATA__ for %s. Marking as OOS.", url)
+        return None
+
+    try:
+        data = json.loads(json_str)
+    except json.JSONDecodeError as e:
+        log.debug("Failed to decode JSON from __TGT_DATA__ for %s: %s. Snippet: %s", url, e, json_str[:1000])
+        return None
+
+    if data.get("__PRELOADED_QUERIES__") and data["__PRELOADED_QUERIES__"].get("queries"):
+        for query_entry in data["__PRELOADED_QUERIES__"]["queries"]:
+            if isinstance(query_entry, list) and len(query_entry) == 2:
+                query_details, query_result = query_entry[0], query_entry[1]
+                if isinstance(query_details, list) and len(query_details) == 2:
+                    query_name, query_params = query_details[0], query_details[1]
+                    if query_name == PDP_QUERY_NAME and isinstance(query_params, dict) and query_params.get("tcin") == tcin:
+                        if query_result and query_result.get("data") and query_result["data"].get("product"):
+                            return query_result["data"]["product"]
+    return {}
+
+# === AVAILABILITY RULES ===
+# The stock decision as data, so it can be retuned around a drop without a code change.
+# "fields" maps each signal name to a path into the pdp product: dotted keys, with
+# [key=value] picking the first list entry whose key equals value. A field is either a bare
+# path or {"path", "default", "upper"}; the default stands in when any step of the path is
+# missing. A RULES_PATH file's fields extend (or override) the ones below.
+# "rules" are tried highest "priority" first (ties keep file order); the first rule whose
+# every "when" condition holds decides the verdict, and "default" decides when none do.
+# A condition is {field: {predicate: argument}}, predicates being RULE_PREDICATES.
+POSITIVE_ONLINE_REASONS = ["AVAILABLE", "IN_STOCK", "PREORDER_SELLABLE"]
+
+DEFAULT_RULES = {
+    "fields": {
+        "street_date": "item.mmbv_content.street_date",
+        "purchasable": "purchasable",
+        "online_eligible": {"path": "item.fulfillment.purchasing_channel_eligibility[channel=ONLINE].is_eligible",
+                            "default": False},
+        "online_reason": {"path": "item.fulfillment.purchasing_channel_eligibility[channel=ONLINE].reason",
+                          "default": "UNKNOWN", "upper": True},
+        "order_limit": {"path": "item.fulfillment.shipping_options.order_limit", "default": -1},
+        "price": "price.current_retail",
+    },
+    "rules": [
+        {"name": "pre_order", "description": "Street date is still in the future",
+         "when": {"street_date": {"after_now": True}}, "in_stock": False},
+        {"name": "not_purchasable", "description": "JSON 'purchasable' is False",
+         "when": {"purchasable": {"is": False}}, "in_stock": False},
+        {"name": "ship_limit_zero", "description": "Online channel OK but shipping order_limit is 0",
+         "when": {"online_eligible": {"truthy": True}, "online_reason": {"in": POSITIVE_ONLINE_REASONS},
+                  "order_limit": {"eq": 0}}, "in_stock": False},
+        {"name": "online_available", "description": "Online channel eligible with a positive reason",
+         "when": {"online_eligible": {"truthy": True}, "online_reason": {"in": POSITIVE_ONLINE_REASONS}},
+         "in_stock": True},
+    ],
+    "default": {"name": "no_shippable_stock", "description": "JSON checks did not confirm shippable stock",
+                "in_stock": False},
 }
 
-DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
-CHECK_INTERVAL = 30
-HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+def _after_now(value):
+    if not value:
+        return False
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc) > datetime.now(timezone.utc)
+    except (TypeError, ValueError):
+        log.debug("Could not parse date: %r", value)
+        return False
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+# predicate -> factory taking the rule's argument and returning a test of the field value
+RULE_PREDICATES = {
+    "is": lambda arg: lambda value: value is arg, # true / false / null only
+    "eq": lambda arg: lambda value: value == arg,
+    "ne": lambda arg: lambda value: value != arg,
+    "in": lambda arg: lambda value, options=tuple(arg): value in options,
+    "not_in": lambda arg: lambda value, options=tuple(arg): value not in options,
+    "truthy": lambda arg: lambda value: bool(value) is bool(arg),
+    "gt": lambda arg: lambda value: _is_number(value) and value > arg,
+    "ge": lambda arg: lambda value: _is_number(value) and value >= arg,
+    "lt": lambda arg: lambda value: _is_number(value) and value < arg,
+    "le": lambda arg: lambda value: _is_number(value) and value <= arg,
+    "after_now": lambda arg: lambda value: _after_now(value) is bool(arg),
 }
-alerted_items = set()
 
-def get_tcin_from_url(url_string):
+_MISSING = object()
+_PATH_STEP_RE = re.compile(r"\.?([^.\[\]=]+)|\[([^.\[\]=]+)=([^\[\]]*)\]")
+
+def _parse_field_path(path):
+    # "a.b[k=v].c" -> (("key", "a"), ("key", "b"), ("select", "k", "v"), ("key", "c"))
+    steps, pos = [], 0
+    while pos < len(path):
+        match = _PATH_STEP_RE.match(path, pos)
+        if not match or (pos and match.group(1) and path[pos] != "."):
+            raise ValueError(f"Bad field path {path!r} at position {pos}")
+        steps.append(("key", match.group(1)) if match.group(1) else ("select", match.group(2), match.group(3)))
+        pos = match.end()
+    if not steps or path.startswith("."):
+        raise ValueError(f"Bad field path {path!r}")
+    return tuple(steps)
+
+def _step(value, step):
+    if step[0] == "key":
+        return value.get(step[1], _MISSING) if isinstance(value, dict) else _MISSING
+    if isinstance(value, list):
+        for entry in value:
+            if isinstance(entry, dict) and entry.get(step[1]) == step[2]:
+                return entry
+    return _MISSING
+
+class _PathNode:
+    # One step of the field-path trie: fields ending here, and the steps continuing from here.
+    __slots__ = ("fields", "children")
+
+    def __init__(self):
+        self.fields = [] # [(name, upper)]
+        self.children = {} # step -> _PathNode
+
+class CompiledRules:
+    # A rule set compiled once: field paths share a trie, so a payload is walked once however
+    # many fields and rules read it, and identical conditions are tested at most once per
+    # decision however many rules repeat them.
+    def __init__(self, spec):
+        fields = dict(DEFAULT_RULES["fields"])
+        fields.update(spec.get("fields") or {})
+        self.defaults = {}
+        self.root = _PathNode()
+        for name, field in fields.items():
+            if isinstance(field, str):
+                field = {"path": field}
+            node = self.root
+            for step in _parse_field_path(field["path"]):
+                node = node.children.setdefault(step, _PathNode())
+            upper = bool(field.get("upper"))
+            node.fields.append((name, upper))
+            default = field.get("default")
+            self.defaults[name] = str(default).upper() if upper and default is not None else default
+
+        self.conditions = [] # [(field, test)]
+        condition_index = {}
+        self.rules = [] # [(name, in_stock, description, condition indexes)]
+        rules = spec.get("rules")
+        if not isinstance(rules, list):
+            raise ValueError("Rule set needs a 'rules' list")
+        ordered = sorted(enumerate(rules), key=lambda pair: (-pair[1].get("priority", 0), pair[0]))
+        names = set()
+        for _, rule in ordered:
+            name = self._rule_head(rule, names)
+            indexes = []
+            for field, predicates in (rule.get("when") or {}).items():
+                if field not in self.defaults:
+                    raise ValueError(f"Rule {name!r} tests unknown field {field!r}")
+                for predicate, arg in predicates.items():
+                    if predicate not in RULE_PREDICATES:
+                        raise ValueError(f"Rule {name!r} uses unknown predicate {predicate!r}")
+                    if predicate == "is" and arg not in (True, False, None):
+                        raise ValueError(f"Rule {name!r}: 'is' takes true, false or null")
+                    key = (field, predicate, json.dumps(arg, sort_keys=True))
+                    if key not in condition_index:
+                        condition_index[key] = len(self.conditions)
+                        self.conditions.append((field, RULE_PREDICATES[predicate](arg)))
+                    indexes.append(condition_index[key])
+            self.rules.append((name, rule["in_stock"], rule.get("description"), tuple(indexes)))
+        default = spec.get("default") or DEFAULT_RULES["default"]
+        name = self._rule_head(default, names)
+        self.default = (default["in_stock"], name, default.get("description"))
+
+    @staticmethod
+    def _rule_head(rule, names):
+        name = rule.get("name")
+        if not name or name in names:
+            raise ValueError(f"Every rule needs a unique 'name' (got {name!r})")
+        if not isinstance(rule.get("in_stock"), bool):
+            raise ValueError(f"Rule {name!r} needs 'in_stock': true or false")
+        names.add(name)
+        return name
+
+    def extract(self, product):
+        # Resolves every field from the payload in one walk of the trie.
+        signals = dict(self.defaults)
+        stack = [(self.root, product)]
+        while stack:
+            node, value = stack.pop()
+            for name, upper in node.fields:
+                signals[name] = str(value).upper() if upper else value
+            for step, child in node.children.items():
+                child_value = _step(value, step)
+                if child_value is not _MISSING:
+                    stack.append((child, child_value))
+        return signals
+
+    def decide(self, signals):
+        # Returns (in_stock, rule name, description) for the first rule that matches.
+        outcomes = [None] * len(self.conditions)
+        for name, in_stock, description, indexes in self.rules:
+            for i in indexes:
+                outcome = outcomes[i]
+                if outcome is None:
+                    field, test = self.conditions[i]
+                    outcome = outcomes[i] = test(signals[field])
+                if not outcome:
+                    break
+            else:
+                return in_stock, name, description
+        return self.default
+
+def load_rules(path=RULES_PATH):
+    if not path:
+        return CompiledRules(DEFAULT_RULES)
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
     try:
-        path_segments = urlparse(url_string).path.strip("/").split("/")
-        for segment in reversed(path_segments):
-            if segment.startswith("A-") and len(segment) > 2 and segment[2:].isdigit():
-                return segment[2:]
-    except Exception as e:
-        print(f"DEBUG: Error extracting TCIN from URL {url_string}: {e}")
+        return CompiledRules(spec)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid rule set in {path}: {e}") from e
+
+# Compiled at import, so parser processes (which re-import this module) use the same rules.
+availability_rules = load_rules()
+
+def pdp_signals(product_data_from_json):
+    # The fields the stock decision reads, pulled out of the product payload once.
+    return availability_rules.extract(product_data_from_json)
+
+def decide_stock(tcin, signals):
+    # Returns (in_stock, name of the rule that decided it).
+    in_stock, rule, description = availability_rules.decide(signals)
+    log.debug("TCIN %s - JSON - %s. Rule '%s' marks it %s. Signals: %s", tcin, description or "Matched",
+              rule, "IN STOCK" if in_stock else "OOS", signals)
+    return in_stock, rule
+
+# === PRODUCT API FETCH MODE ===
+def _normalize_api_product(summary):
+    # Batch summaries carry fulfillment next to item rather than inside it; reshape them
+    # to the pdp product layout so pdp_signals/decide_stock see the same structure.
+    product = dict(summary)
+    item = dict(product.get("item") or {})
+    if "fulfillment" in product and "fulfillment" not in item:
+        item["fulfillment"] = product.pop("fulfillment")
+    product["item"] = item
+    return product
+
+def fetch_api_products(tcins, store_id=None):
+    # Returns {tcin: product} for every TCIN the API answered for. One request per call:
+    # a single TCIN uses the pdp endpoint, several are batched into one summary request.
+    # Passing store_id always uses the summary endpoint, whose store_options cover that store.
+    store = store_id or PRODUCT_API_STORE_ID
+    params = {"key": PRODUCT_API_KEY, "store_id": store, "pricing_store_id": store}
+    headers = {"Accept": "application/json"}
+    if len(tcins) == 1 and store_id is None:
+        response = fetch_governor.get(PRODUCT_API_URL, params=dict(params, tcin=tcins[0]), headers=headers)
+        response.raise_for_status()
+        product = (response.json().get("data") or {}).get("product")
+        return {tcins[0]: product} if product else {}
+
+    response = fetch_governor.get(PRODUCT_API_BATCH_URL, params=dict(params, tcins=",".join(tcins)), headers=headers)
+    response.raise_for_status()
+    products = {}
+    for summary in (response.json().get("data") or {}).get("product_summaries") or []:
+        if isinstance(summary, dict) and str(summary.get("tcin")) in tcins:
+            products[str(summary["tcin"])] = _normalize_api_product(summary)
+    return products
+
+def api_stock_statuses(tcins):
+    # Same decision logic as the HTML path, fed from API JSON. TCINs the API didn't
+    # return are left out so the caller can fall back to the product page.
+    statuses = {}
+    with metrics.stage("api_fetch"):
+        products = fetch_api_products(tcins)
+    for tcin, product in products.items():
+        log.debug("TCIN %s - Using product API data.", tcin)
+        signals = pdp_signals(product)
+        with metrics.stage("decision"):
+            in_stock, rule = decide_stock(tcin, signals)
+        statuses[tcin] = CheckResult(in_stock, signals, rule=rule)
+    return statuses
+
+# === STORE AVAILABILITY ===
+# One store's pickup/drive-up answer for one TCIN; `signals` holds the raw statuses it was decided from.
+StoreStatus = namedtuple("StoreStatus", ["store_id", "available", "signals", "checked_at"])
+
+POSITIVE_STORE_STATUSES = ("IN_STOCK", "LIMITED_STOCK")
+
+def fetch_nearby_store_ids(zip_code):
+    params = {"key": PRODUCT_API_KEY, "place": zip_code, "limit": STORE_ZIP_LIMIT, "within": STORE_ZIP_RADIUS, "unit": "mile"}
+    response = fetch_governor.get(STORE_LOOKUP_URL, params=params, headers={"Accept": "application/json"})
+    response.raise_for_status()
+    stores = ((response.json().get("data") or {}).get("nearby_stores") or {}).get("stores") or []
+    return [str(store["store_id"]) for store in stores if isinstance(store, dict) and store.get("store_id")]
+
+def store_signals(product, store_id):
+    # The store_options entry for store_id from a product summary, or None if the store wasn't reported.
+    fulfillment = (product.get("item") or {}).get("fulfillment") or {}
+    for option in fulfillment.get("store_options") or []:
+        if isinstance(option, dict) and str(option.get("location_id")) == store_id:
+            return {
+                "pickup": str((option.get("order_pickup") or {}).get("availability_status", "UNKNOWN")).upper(),
+                "drive_up": str((option.get("drive_up") or {}).get("availability_status", "UNKNOWN")).upper(),
+                "in_store": str((option.get("in_store_only") or {}).get("availability_status", "UNKNOWN")).upper(),
+                "quantity": option.get("location_available_to_promise_quantity"),
+                "store_name": option.get("location_name"),
+            }
     return None
 
-def is_in_stock(url):
-    tcin = get_tcin_from_url(url)
-    if not tcin:
-        print(f"DEBUG: Could not extract TCIN for URL: {url}. Marking as OOS.")
-        return False
-    print(f"DEBUG: Extracted TCIN {tcin} for URL {url}")
+def decide_store_stock(tcin, store_id, signals):
+    if signals["pickup"] in POSITIVE_STORE_STATUSES or signals["drive_up"] in POSITIVE_STORE_STATUSES:
+        log.debug("TCIN %s - Store %s pickup '%s', drive up '%s'. Marking AVAILABLE.", tcin, store_id,
+                  signals["pickup"], signals["drive_up"])
+        return True
+    log.debug("TCIN %s - Store %s pickup '%s', drive up '%s'. Marking unavailable.", tcin, store_id,
+              signals["pickup"], signals["drive_up"])
+    return False
+
+class StoreMonitor:
+    # Fans the watchlist out across STORE_IDS plus the stores nearest each of STORE_ZIPS. Each
+    # store gets one summary request per PRODUCT_API_BATCH_SIZE TCINs, run on the check engine's
+    # pool, so a sweep costs stores x ceil(products / batch) requests rather than stores x products.
+    # Answers are cached per (tcin, store) for STORE_RESULT_TTL and fresh pairs are not re-queried.
+    def __init__(self, engine, store_ids=None, zips=None, interval=STORE_CHECK_INTERVAL, ttl=STORE_RESULT_TTL):
+        self.engine = engine
+        self.store_ids = list(STORE_IDS if store_ids is None else store_ids)
+        self.zips = list(STORE_ZIPS if zips is None else zips)
+        self.interval = interval
+        self.ttl = ttl
+        self.cache = {} # (tcin, store_id) -> StoreStatus
+        self.next_sweep = 0.0
+        self._zip_stores = None
+        self._pending = {}
+
+    @property
+    def enabled(self):
+        return bool(self.store_ids or self.zips)
 
+    def stores(self):
+        # ZIP codes are resolved to store IDs once; a failed lookup is retried on the next sweep.
+        if self._zip_stores is None and self.zips:
+            found = []
+            try:
+                for zip_code in self.zips:
+                    found.extend(fetch_nearby_store_ids(zip_code))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                log.warning("⚠️ Could not look up stores near %s: %s", zip_code, e)
+            else:
+                self._zip_stores = found
+                log.info("🏬 Stores near %s: %s", ", ".join(self.zips), ", ".join(found) or "none")
+        return list(dict.fromkeys(self.store_ids + (self._zip_stores or [])))
+
+    def due(self, now):
+        return self.enabled and not self._pending and now >= self.next_sweep
+
+    def start_sweep(self, products, now):
+        # Queues batched checks for every stale (product, store) pair; returns the number of requests queued.
+        self.next_sweep = now + self.interval
+        fresh_after = time.time() - self.ttl
+        size = max(1, PRODUCT_API_BATCH_SIZE)
+        queued = 0
+        for store_id in self.stores():
+            stale = [product for product in products
+                     if (cached := self.cache.get((product.tcin, store_id))) is None or cached.checked_at < fresh_after]
+            for i in range(0, len(stale), size):
+                batch = stale[i:i + size]
+                self._pending[self.engine.executor.submit(self._check_batch, store_id, batch)] = store_id
+                queued += 1
+        return queued
+
+    def _check_batch(self, store_id, batch):
+        log.debug("🏬 Checking %s products at store %s", len(batch), store_id)
+        with self.engine.host_limiter.slot(PRODUCT_API_BATCH_URL):
+            with metrics.stage("store_fetch"):
+                products = fetch_api_products([product.tcin for product in batch], store_id=store_id)
+        checked_at = time.time()
+        statuses = []
+        for product in batch:
+            signals = store_signals(products[product.tcin], store_id) if product.tcin in products else None
+            if signals is not None: # Unreported pairs stay unknown rather than unavailable
+                statuses.append((product, StoreStatus(store_id, decide_store_stock(product.tcin, store_id, signals),
+                                                      signals, checked_at)))
+        return statuses
+
+    def in_flight(self):
+        return len(self._pending)
+
+    def collect(self):
+        # Returns [(Product, StoreStatus)] from batches that have finished; never blocks.
+        completed = []
+        for future in [future for future in self._pending if future.done()]:
+            store_id = self._pending.pop(future)
+            try:
+                statuses = future.result()
+            except Exception as e:
+                log.warning("⚠️ Error checking availability at store %s: %s", store_id, e)
+                metrics.inc("restock_errors_total", help_text="Failed checks by error type.",
+                            type=f"store_{getattr(e, 'kind', type(e).__name__)}")
+                continue
+            for product, status in statuses:
+                self.cache[(product.tcin, store_id)] = status
+                metrics.inc("restock_store_verdicts_total", help_text="Store availability verdicts.",
+                            verdict="available" if status.available else "unavailable")
+                completed.append((product, status))
+        return completed
+
+    def forget(self, tcin):
+        for key in [key for key in self.cache if key[0] == tcin]:
+            del self.cache[key]
+
+# === ALERTS ===
+def build_alert_payload(alerts):
+    # alerts is [(product_name, url, queued_at, key)]; several restocks become one message with an embed each.
+    if len(alerts) == 1:
+        product_name, url, _, _ = alerts[0]
+        content = f"🔔 **{product_name} is back in stock!**\n{url}"
+    else:
+        content = f"🔔 **{len(alerts)} products are back in stock!**"
+    return {
+        "content": content,
+        "username": "Target Restock Bot",
+        "embeds": [{"title": product_name[:256], "url": url, "description": "Back in stock!"} for product_name, url, _, _ in alerts],
+    }
+
+def _retry_after_seconds(response):
+    # Discord sends Retry-After as a header and retry_after (seconds) in the JSON body.
     try:
-        print(f"DEBUG: Fetching URL: {url}")
-        response = requests.get(url, headers=HEADERS, timeout=20)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # --- Save HTML for debugging (can be commented out once stable) ---
-        # try:
-        #     product_id_for_filename = tcin
-        #     safe_product_id_part = "".join(c if c.isalnum() or c in ['-', '_'] else '_' for c in product_id_for_filename)
-        #     filename = f"debug_target_page_A-{safe_product_id_part}.html"
-        #     with open(filename, "w", encoding="utf-8") as f:
-        #         f.write(soup.prettify())
-        # except Exception as e:
-        #     print(f"DEBUG: Could not save HTML to file for {url}: {e}")
-        # --- End Save HTML ---
-
-        # --- HTML Check for Add to Cart Button ---
-        # These are common data-test attributes. You might need to adjust them
-        # by inspecting the HTML of an in-stock item.
-        possible_atc_button_selectors = [
-            {"data-test": "addToCartButton"},
-            {"data-test": "shippingButton"} 
-            # Add more selectors if Target uses others for the main purchase button
-        ]
-        
-        found_active_atc_button_in_html = False
-        atc_button_details = "No primary ATC button found in HTML"
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(response.json().get("retry_after"))
+    except (TypeError, ValueError, AttributeError):
+        return None
 
-        for selector in possible_atc_button_selectors:
-            button = soup.find("button", attrs=selector)
-            if button:
-                selector_str = ", ".join([f"{k}='{v}'" for k,v in selector.items()])
-                if 'disabled' in button.attrs:
-                    atc_button_details = f"Button {selector_str} found but DISABLED in HTML."
-                    print(f"DEBUG: TCIN {tcin} - {atc_button_details}")
-                    # If a primary button is found and explicitly disabled, likely OOS for that method
-                    # For now, we'll let JSON confirm, but this is a strong negative signal.
-                else:
-                    atc_button_details = f"Button {selector_str} found and ACTIVE in HTML."
-                    print(f"DEBUG: TCIN {tcin} - {atc_button_details}")
-                    found_active_atc_button_in_html = True
-                    break # Found an active button
-            # else:
-                # print(f"DEBUG: TCIN {tcin} - Button with selector {selector} NOT found in HTML.")
-        
-        # If no active primary purchase button is found in the initial HTML,
-        # it's a strong indicator of OOS, especially for shippable items.
-        if not found_active_atc_button_in_html:
-            print(f"DEBUG: TCIN {tcin} - No clearly active 'Add to Cart' or 'Shipping' button found in initial HTML. Details: {atc_button_details}. Marking OOS.")
-            return False
-        
-        # --- JSON Verification (If HTML check passed) ---
-        print(f"DEBUG: TCIN {tcin} - Active button found in HTML, proceeding to JSON verification.")
-        script_tag = soup.find("script", string=lambda t: t and "__TGT_DATA__" in t)
-        if not script_tag or not script_tag.string:
-            print(f"DEBUG: TCIN {tcin} - __TGT_DATA__ script tag not found or empty. Marking as OOS despite HTML button.")
-            return False
+class AlertDispatcher:
+    # Delivers Discord alerts from a queue on a background thread so the check loop never
+    # waits on a webhook POST. Restocks queued within ALERT_COALESCE_WINDOW of each other are
+    # merged into one message, 429s and exhausted rate-limit buckets are waited out, and other
+    # failures are retried with exponential backoff. on_delivered(key) is called from the
+    # dispatcher thread for each keyed alert once Discord has accepted it.
+    def __init__(self, webhook_url=None, coalesce_window=ALERT_COALESCE_WINDOW, max_retries=ALERT_MAX_RETRIES,
+                 on_delivered=None):
+        self.webhook_url = webhook_url or DISCORD_WEBHOOK_URL
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.on_delivered = on_delivered
+        self.queue = queue.Queue()
+        self.delivered = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=256) # Seconds from enqueue to successful delivery
+        self._in_progress = 0
+        self._blocked_until = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+                self._thread.start()
+        return self
 
-        content = script_tag.string
-        json_str = None
-        match = re.search(
-            r"['\"]__TGT_DATA__['\"]\s*:\s*\{\s*configurable:\s*false,\s*enumerable:\s*true,\s*value:\s*deepFreeze\(JSON\.parse\((.*?)\)\),\s*writable:\s*false\s*\}",
-            content, re.DOTALL
-        )
-        if match:
-            json_arg_str = match.group(1).strip()
-            if (json_arg_str.startswith('"') and json_arg_str.endswith('"')) or \
-               (json_arg_str.startswith("'") and json_arg_str.endswith("'")):
-                json_str = json_arg_str[1:-1]
+    def stop(self, timeout=10):
+        # Flushes whatever is still queued, then stops the worker thread.
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def enqueue(self, product_name, url, key=None):
+        self.queue.put((product_name, url, time.monotonic(), key))
+
+    def queue_depth(self):
+        return self.queue.qsize() + self._in_progress
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "queue_depth": self.queue_depth(),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "last_latency": latencies[-1] if latencies else None,
+            "avg_latency": sum(latencies) / len(latencies) if latencies else None,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.coalesce_window
+            while len(batch) < ALERT_MAX_EMBEDS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
                 try:
-                    json_str = json_str.encode('latin-1', 'backslashreplace').decode('unicode-escape')
-                except Exception as e:
-                    print(f"DEBUG: Error during unicode_escape of JSON string for {url}: {e}")
-                    return False # Error during parsing
-            else: # Should not happen if regex is correct and HTML structure is as expected
-                print(f"DEBUG: Captured JSON argument for __TGT_DATA__ is not correctly quoted: {json_arg_str[:100]}...")
-                return False
-        else:
-            print(f"DEBUG: Could not regex parse the JSON block from __TGT_DATA__ for {url}.")
-            return False
-        
-        if not json_str:
-            print(f"DEBUG: Could not extract JSON string from __TGT_DATA__ for {url}. Marking as OOS.")
-            return False
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._in_progress = len(batch)
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                log.error("🚨 An unexpected error occurred while sending Discord alert: %s", e)
+                self.failed += len(batch)
+                metrics.inc("restock_alerts_failed_total", len(batch), help_text="Restock alerts Discord never accepted.")
+            self._in_progress = 0
 
+    def _note_rate_limit(self, response):
+        # Discord's per-bucket headers tell us when the next request would be rejected.
         try:
-            data = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"DEBUG: Failed to decode JSON from __TGT_DATA__ for {url}: {e}. Snippet: {json_str[:1000]}")
-            return False
+            if int(response.headers.get("X-RateLimit-Remaining", "1")) <= 0:
+                reset_after = float(response.headers.get("X-RateLimit-Reset-After", "1"))
+                self._blocked_until = max(self._blocked_until, time.monotonic() + reset_after)
+        except (TypeError, ValueError):
+            pass
 
-        product_data_from_json = None
-        if data.get("__PRELOADED_QUERIES__") and data["__PRELOADED_QUERIES__"].get("queries"):
-            for query_entry in data["__PRELOADED_QUERIES__"]["queries"]:
-                if isinstance(query_entry, list) and len(query_entry) == 2:
-                    query_details, query_result = query_entry[0], query_entry[1]
-                    if isinstance(query_details, list) and len(query_details) == 2:
-                        query_name, query_params = query_details[0], query_details[1]
-                        if query_name == "@web/domain-product/get-pdp-v1" and isinstance(query_params, dict) and query_params.get("tcin") == tcin:
-                            if query_result and query_result.get("data") and query_result["data"].get("product"):
-                                product_data_from_json = query_result["data"]["product"]
-                                break
-        
-        if not product_data_from_json:
-            print(f"DEBUG: Product data for TCIN {tcin} not found in __TGT_DATA__ JSON. Marking OOS.")
-            return False
+    def deliver(self, batch):
+        names = ", ".join(product_name for product_name, _, _, _ in batch)
+        payload = build_alert_payload(batch)
+        delay = 1.0
+        for attempt in range(self.max_retries + 1):
+            wait_for = self._blocked_until - time.monotonic()
+            if wait_for > 0:
+                time.sleep(wait_for)
+            try:
+                response = get_http_client().post(self.webhook_url, json=payload, timeout=(CONNECT_TIMEOUT, 10))
+            except requests.exceptions.RequestException as e:
+                log.error("🚨 Failed to send Discord alert for %s (attempt %s): %s", names, attempt + 1, e)
+                time.sleep(delay)
+                delay *= 2
+                continue
 
-        # Pre-order Check
-        street_date_str = product_data_from_json.get("item", {}).get("mmbv_content", {}).get("street_date")
-        if street_date_str:
+            self._note_rate_limit(response)
+            if response.status_code == 429:
+                retry_after = _retry_after_seconds(response) or delay
+                log.warning("⏳ Discord rate limited the alert for %s, retrying in %.1fs.", names, retry_after)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+                delay *= 2
+                continue
+            if response.status_code >= 500:
+                log.error("🚨 Discord returned %s for %s (attempt %s), retrying.", response.status_code, names, attempt + 1)
+                time.sleep(delay)
+                delay *= 2
+                continue
             try:
-                street_date = datetime.strptime(street_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                current_date = datetime.now(timezone.utc)
-                if street_date > current_date:
-                    print(f"DEBUG: TCIN {tcin} - Pre-order (Street Date: {street_date_str}). Marking OOS.")
-                    return False
-            except ValueError:
-                print(f"DEBUG: TCIN {tcin} - Could not parse street_date: {street_date_str}")
-
-        # JSON based checks for shipping
-        is_product_purchasable_json = product_data_from_json.get("purchasable")
-        
-        online_channel_eligible_json = False
-        online_channel_reason_json = "UNKNOWN"
-        purchasing_channels = product_data_from_json.get("item", {}).get("fulfillment", {}).get("purchasing_channel_eligibility", [])
-        for channel_info in purchasing_channels:
-            if isinstance(channel_info, dict) and channel_info.get("channel") == "ONLINE":
-                online_channel_eligible_json = channel_info.get("is_eligible", False)
-                online_channel_reason_json = str(channel_info.get("reason", "UNKNOWN")).upper()
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                log.error("🚨 Failed to send Discord alert for %s: %s", names, e)
                 break
-        
-        shipping_options_data = product_data_from_json.get("item", {}).get("fulfillment", {}).get("shipping_options", {})
-        if not isinstance(shipping_options_data, dict): shipping_options_data = {}
-        shipping_order_limit_json = shipping_options_data.get("order_limit", -1)
-        
-        print(f"DEBUG: TCIN {tcin} - JSON - Purchasable: {is_product_purchasable_json}, OnlineChannelEligible: {online_channel_eligible_json}, OnlineChannelReason: '{online_channel_reason_json}', ShipLimit: {shipping_order_limit_json}")
-
-        if is_product_purchasable_json is False:
-            print(f"DEBUG: TCIN {tcin} - JSON 'purchasable' is False. Marking OOS.")
-            return False
 
-        positive_online_reasons = ["AVAILABLE", "IN_STOCK", "PREORDER_SELLABLE"]
-        if online_channel_eligible_json and online_channel_reason_json in positive_online_reasons:
-            if shipping_order_limit_json == 0:
-                 print(f"DEBUG: TCIN {tcin} - JSON Online channel OK ('{online_channel_reason_json}') but shipping_order_limit is 0. Marking OOS.")
-                 return False
-            print(f"DEBUG: TCIN {tcin} - JSON Online channel eligible and reason '{online_channel_reason_json}' is positive. Marking IN STOCK.")
+            delivered_at = time.monotonic()
+            for _, _, queued_at, _ in batch:
+                self.latencies.append(delivered_at - queued_at)
+                metrics.observe("restock_alert_delivery_seconds", delivered_at - queued_at, LAG_BUCKETS,
+                                "Time from queueing an alert to Discord accepting it.")
+            self.delivered += len(batch)
+            metrics.inc("restock_alerts_sent_total", len(batch), help_text="Restock alerts delivered to Discord.")
+            log.info("✅ Alert sent for %s: %s (latency %.1fs, queue depth %s)",
+                     names, response.status_code, delivered_at - batch[0][2], self.queue.qsize())
+            for _, _, _, key in batch:
+                if key is not None and self.on_delivered is not None:
+                    try:
+                        self.on_delivered(key)
+                    except Exception as e:
+                        log.warning("⚠️ Could not record delivery of alert %s: %s", key, e)
             return True
-        
-        print(f"DEBUG: TCIN {tcin} - JSON checks did not confirm shippable stock. OnlineChannelEligible: {online_channel_eligible_json} (Reason: '{online_channel_reason_json}'). Marking OOS.")
-        return False
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error checking {url}: RequestException - {e}")
-        return False
-    except Exception as e:
-        print(f"An unexpected error occurred in is_in_stock for {url}: {e}")
-        import traceback
-        traceback.print_exc() 
+        self.failed += len(batch)
+        metrics.inc("restock_alerts_failed_total", len(batch), help_text="Restock alerts Discord never accepted.")
+        log.error("🚨 Giving up on Discord alert for %s.", names)
         return False
 
-def send_discord_alert(product_name, url):
+_alert_dispatcher = None
+
+def get_alert_dispatcher():
+    global _alert_dispatcher
+    if _alert_dispatcher is None:
+        with _http_client_lock:
+            if _alert_dispatcher is None:
+                _alert_dispatcher = AlertDispatcher().start()
+    return _alert_dispatcher
+
+def send_discord_alert(product_name, url, key=None):
+    # Queues the alert; delivery happens on the dispatcher thread. `key` (a TCIN, or
+    # "<tcin>@<store id>") is handed to the dispatcher's on_delivered once it has gone out.
     if not DISCORD_WEBHOOK_URL:
-        print("🚨 DISCORD_WEBHOOK_URL is not set. Cannot send alert.")
+        log.error("🚨 DISCORD_WEBHOOK_URL is not set. Cannot send alert.")
         return
-    data = {
-        "content": f"🔔 **{product_name} is back in stock!**\n{url}",
-        "username": "Target Restock Bot"
-    }
+    get_alert_dispatcher().enqueue(product_name, url, key)
+
+# === STATE JOURNAL ===
+SavedState = namedtuple("SavedState", ["in_stock", "alerted", "signals", "checked_at", "changed_at"])
+
+class StateStore:
+    # Persists each product's last verdict, alert flag and JSON signals, plus a row per stock
+    # transition, in SQLite. record() only queues; a writer thread commits everything queued
+    # in one transaction every STATE_FLUSH_INTERVAL seconds, so checks never wait on fsync.
+    # The alert flag is only persisted once alert_delivered() confirms Discord took the alert,
+    # so an alert lost with the queue in a crash is sent again after the restart.
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS products (tcin TEXT PRIMARY KEY, name TEXT, in_stock INTEGER, alerted INTEGER,"
+        " signals TEXT, checked_at REAL, changed_at REAL)",
+        "CREATE TABLE IF NOT EXISTS transitions (tcin TEXT, at REAL, in_stock INTEGER, signals TEXT)",
+        "CREATE INDEX IF NOT EXISTS transitions_tcin_at ON transitions (tcin, at)",
+    )
+    PRUNE_EVERY = 3600 # Seconds between deletes of transitions older than history_days
+
+    def __init__(self, path=None, flush_interval=STATE_FLUSH_INTERVAL, history_days=STATE_HISTORY_DAYS):
+        self.path = path or STATE_DB_PATH
+        self.flush_interval = flush_interval
+        self.history_days = history_days
+        self.queue = queue.Queue()
+        self.verdicts = {} # tcin -> (in_stock, alerted) as last recorded
+        self.delivered = set() # Keys whose current alert reached Discord
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def load(self):
+        # Returns {tcin: SavedState} from the last run and primes record()'s transition detection.
+        started = time.perf_counter()
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute(
+                    "SELECT tcin, in_stock, alerted, signals, checked_at, changed_at FROM products").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not load saved state from %s: %s. Starting fresh.", self.path, e)
+            return {}
+        saved = {}
+        for tcin, in_stock, alerted, signals, checked_at, changed_at in rows:
+            saved[tcin] = SavedState(bool(in_stock), bool(alerted), json.loads(signals) if signals else None,
+                                     checked_at, changed_at)
+            self.verdicts[tcin] = (bool(in_stock), bool(alerted))
+            if alerted:
+                self.delivered.add(tcin)
+        log.info("💾 Loaded saved state for %s products from %s in %.1fms.", len(saved), self.path,
+                 (time.perf_counter() - started) * 1000)
+        return saved
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        # Flushes whatever is still queued, then stops the writer thread.
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record(self, product, result, alerted, now=None, key=None):
+        # Queues a check outcome; a change of verdict also appends a transition row.
+        # Store results pass key="<tcin>@<store id>" so each pair has its own row and history.
+        # `alerted` is the in-memory flag, set as soon as an alert is queued; it is written
+        # as set only once that alert has been delivered.
+        tcin = key or product.tcin
+        with self._lock:
+            if not alerted:
+                self.delivered.discard(tcin)
+            alerted = alerted and tcin in self.delivered
+            previous = self.verdicts.get(tcin)
+            changed = previous is None or previous[0] != result.in_stock
+            self.verdicts[tcin] = (result.in_stock, alerted)
+            self.queue.put((tcin, product.name, result.in_stock, alerted, result.signals,
+                            time.time() if now is None else now, changed))
+
+    def alert_delivered(self, key):
+        # Called from the alert dispatcher's thread; sets the persisted flag for key's row.
+        with self._lock:
+            self.delivered.add(key)
+            previous = self.verdicts.get(key)
+            if previous is not None:
+                self.verdicts[key] = (previous[0], True)
+            self.queue.put((key, None, None, True, None, None, None))
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        conn = self._connect()
+        next_prune = 0.0
+        try:
+            while True:
+                stopping = self._stop.wait(self.flush_interval)
+                batch = []
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch:
+                    self._flush(conn, batch)
+                if self.history_days > 0 and time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + self.PRUNE_EVERY
+                    self._prune(conn)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def _flush(self, conn, batch):
+        # Only the newest row per TCIN is upserted; every transition in the batch is kept.
+        # Delivery confirmations (name None) set the flag on the newest row, or on the stored
+        # row if this batch has none for that TCIN.
+        latest = {}
+        changed_at = {}
+        transitions = []
+        delivered = set()
+        for tcin, name, in_stock, alerted, signals, at, changed in batch:
+            if name is None:
+                if tcin in latest:
+                    latest[tcin] = latest[tcin][:3] + (1,) + latest[tcin][4:]
+                else:
+                    delivered.add(tcin)
+                continue
+            delivered.discard(tcin)
+            signals_json = json.dumps(signals, sort_keys=True) if signals is not None else None
+            if changed:
+                changed_at[tcin] = at
+                transitions.append((tcin, at, int(in_stock), signals_json))
+            latest[tcin] = (tcin, name, int(in_stock), int(alerted), signals_json, at)
+        rows = [row + (changed_at.get(tcin),) for tcin, row in latest.items()]
+        try:
+            with metrics.timer("restock_state_flush_seconds", STAGE_BUCKETS, "Time to commit one batch of state writes."):
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO products (tcin, name, in_stock, alerted, signals, checked_at, changed_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(tcin) DO UPDATE SET name = excluded.name,"
+                        " in_stock = excluded.in_stock, alerted = excluded.alerted, signals = excluded.signals,"
+                        " checked_at = excluded.checked_at, changed_at = COALESCE(excluded.changed_at, products.changed_at)",
+                        rows)
+                    conn.executemany("INSERT INTO transitions (tcin, at, in_stock, signals) VALUES (?, ?, ?, ?)", transitions)
+                    conn.executemany("UPDATE products SET alerted = 1 WHERE tcin = ?", [(tcin,) for tcin in delivered])
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not write %s state updates to %s: %s", len(batch), self.path, e)
+            self.failed += len(batch)
+            metrics.inc("restock_state_write_failures_total", len(batch), help_text="State updates that never reached disk.")
+
+    def _prune(self, conn):
+        try:
+            with conn:
+                conn.execute("DELETE FROM transitions WHERE at < ?", (time.time() - self.history_days * 86400,))
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not prune old transitions in %s: %s", self.path, e)
+
+    def transitions(self, tcin, limit=100):
+        # Newest-first (at, in_stock, signals) history for one product, read on a separate connection.
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT at, in_stock, signals FROM transitions WHERE tcin = ? ORDER BY at DESC LIMIT ?",
+                                (tcin, limit)).fetchall()
+        finally:
+            conn.close()
+        return [(at, bool(in_stock), json.loads(signals) if signals else None) for at, in_stock, signals in rows]
+
+# === CAPTURE ARCHIVE ===
+# One captured product page fetch. `body` is None for failed fetches and 304s.
+CaptureRecord = namedtuple("CaptureRecord", ["at", "tcin", "url", "status", "encoding", "elapsed", "failure", "body"])
+
+class CaptureArchive:
+    # Appends raw product page fetches to gzip segments in a directory: one JSON line per
+    # fetch (wall-clock time, TCIN, status, encoding, fetch seconds, failure kind and the
+    # sha256 of the body). A body's bytes follow its line only the first time that digest
+    # appears in the segment, so a page that doesn't change costs one copy per segment.
+    # Segments rotate once their compressed size passes segment_bytes and only the newest
+    # `keep` are kept. record() only queues; if the writer thread falls behind, captures
+    # are dropped rather than slowing checks down.
+    PREFIX = "capture-"
+    SUFFIX = ".jsonl.gz"
+
+    def __init__(self, directory=None, segment_bytes=CAPTURE_SEGMENT_BYTES, keep=CAPTURE_KEEP_SEGMENTS, max_queued=1000):
+        self.directory = directory or CAPTURE_DIR
+        self.segment_bytes = segment_bytes
+        self.keep = max(1, keep)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.written = 0
+        self.stored_bodies = 0
+        self.dropped = 0
+        self._file = None
+        self._raw = None
+        self._digests = set() # Bodies already in the current segment
+        self._thread = None
+
+    @classmethod
+    def segments(cls, directory):
+        # Segment paths in write order.
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in sorted(names)
+                if name.startswith(cls.PREFIX) and name.endswith(cls.SUFFIX)]
+
+    def start(self):
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        # Writes whatever is still queued, then closes the current segment.
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record(self, tcin, url, status=None, encoding=None, body=None, elapsed=None, failure=None, at=None):
+        try:
+            self.queue.put_nowait(CaptureRecord(time.time() if at is None else at, tcin, url, status, encoding,
+                                                elapsed, failure, body))
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc("restock_captures_dropped_total", help_text="Captures dropped because the writer fell behind.")
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _open_segment(self):
+        # Always starts a new segment; a previous run's last one may end mid-stream.
+        existing = self.segments(self.directory)
+        number = int(os.path.basename(existing[-1])[len(self.PREFIX):-len(self.SUFFIX)]) + 1 if existing else 1
+        path = os.path.join(self.directory, f"{self.PREFIX}{number:08d}{self.SUFFIX}")
+        self._raw = open(path, "wb")
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6)
+        self._digests = set()
+        for old in existing[:max(0, len(existing) + 1 - self.keep)]:
+            try:
+                os.remove(old)
+            except OSError as e:
+                log.warning("⚠️ Could not remove old capture segment %s: %s", old, e)
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+    def _write(self, record):
+        if self._file is None:
+            self._open_segment()
+        entry = {"at": record.at, "tcin": record.tcin, "url": record.url, "status": record.status,
+                 "encoding": record.encoding, "elapsed": record.elapsed, "failure": record.failure}
+        body = None
+        if record.body is not None:
+            entry["sha256"] = digest = hashlib.sha256(record.body).hexdigest()
+            if digest not in self._digests:
+                self._digests.add(digest)
+                entry["size"] = len(record.body)
+                body = record.body
+                self.stored_bodies += 1
+        self._file.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+        if body is not None:
+            self._file.write(body)
+        self.written += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                while record is not None:
+                    self._write(record)
+                    if self._raw.tell() >= self.segment_bytes:
+                        self._close_segment()
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if self._file is not None:
+                    # A sync flush makes everything so far readable even if the process dies.
+                    self._file.flush(zlib.Z_SYNC_FLUSH)
+            except (OSError, ValueError) as e:
+                log.warning("⚠️ Could not write capture archive in %s: %s", self.directory, e)
+                self._close_segment()
+            if record is None:
+                self._close_segment()
+                return
+
+def read_capture_archive(directory):
+    # Yields CaptureRecords from every segment in write order, with bodies resolved by digest.
+    # A segment cut short by a crash yields what was flushed before it.
+    for path in CaptureArchive.segments(directory):
+        bodies = {}
+        try:
+            with gzip.open(path, "rb") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    digest = entry.get("sha256")
+                    if "size" in entry:
+                        bodies[digest] = f.read(entry["size"])
+                    yield CaptureRecord(entry["at"], entry["tcin"], entry["url"], entry.get("status"), entry.get("encoding"),
+                                        entry.get("elapsed"), entry.get("failure"), bodies.get(digest))
+        except (EOFError, OSError, zlib.error, json.JSONDecodeError) as e:
+            log.debug("Capture segment %s ends early: %s", path, e)
+
+capture_archive = None # Set by main() when CAPTURE_DIR is configured
+
+# === STATUS API ===
+class SignalSnapshot:
+    # The decision signals plus price from one check in a fixed slot layout instead of a
+    # dict: under 100 bytes each, with the reason and street date strings interned, so a
+    # history per product stays small at tens of thousands of products.
+    FIELDS = ("purchasable", "online_eligible", "online_reason", "order_limit", "street_date", "price")
+    __slots__ = ("at", "in_stock") + FIELDS
+
+    def __init__(self, at, in_stock, signals):
+        self.at = at
+        self.in_stock = in_stock
+        for field in self.FIELDS:
+            value = signals.get(field)
+            setattr(self, field, sys.intern(value) if isinstance(value, str) else value)
+
+    def signals(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def diff(self, previous):
+        # [(field, old, new)] for every signal that differs from `previous`.
+        return [(field, getattr(previous, field), getattr(self, field)) for field in self.FIELDS
+                if getattr(previous, field) != getattr(self, field)]
+
+    def as_dict(self):
+        return dict(self.signals(), at=self.at, in_stock=self.in_stock)
+
+class SnapshotRing:
+    # The last `size` distinct snapshots of one product in a preallocated list, oldest first
+    # when iterated. Only changes are appended, so the ring spans hours of an idle product.
+    __slots__ = ("slots", "count")
+
+    def __init__(self, size=SNAPSHOT_HISTORY):
+        self.slots = [None] * max(1, size)
+        self.count = 0
+
+    def append(self, snapshot):
+        self.slots[self.count % len(self.slots)] = snapshot
+        self.count += 1
+
+    def latest(self):
+        return self.slots[(self.count - 1) % len(self.slots)] if self.count else None
+
+    def __iter__(self):
+        size = len(self.slots)
+        for i in range(max(0, self.count - size), self.count):
+            yield self.slots[i % size]
+
+class AvailabilityCache:
+    # Latest verdict, signals and timestamps per TCIN (plus per-store pickup answers), a
+    # SnapshotRing of signal changes per TCIN, and a numbered ring of recent transitions and
+    # signal deltas. The main loop writes it; the status API's threads only read it, so
+    # asking the monitor never causes a fetch.
+    def __init__(self, history=STATUS_EVENT_HISTORY, snapshot_history=SNAPSHOT_HISTORY):
+        self._cond = threading.Condition()
+        self.items = {}
+        self.snapshots = {} # tcin -> SnapshotRing
+        self.snapshot_history = snapshot_history
+        self.events = deque(maxlen=history)
+        self.seq = 0
+
+    def _item(self, tcin, name, url):
+        item = self.items.get(tcin)
+        if item is None:
+            item = self.items[tcin] = {"tcin": tcin, "in_stock": None, "signals": None, "rule": None, "checked_at": None,
+                                       "changed_at": None, "failure": None, "failed_at": None, "stores": {}}
+        item["name"], item["url"] = name, url
+        return item
+
+    def _publish(self, event):
+        # Caller holds the condition.
+        self.seq += 1
+        event["id"] = self.seq
+        self.events.append(event)
+        self._cond.notify_all()
+
+    def seed(self, product, in_stock, signals, checked_at, changed_at):
+        # Fills in a verdict from the state journal at startup without announcing it as a transition.
+        with self._cond:
+            self._item(product.tcin, product.name, product.url).update(
+                in_stock=in_stock, signals=signals, checked_at=checked_at, changed_at=changed_at)
+            if signals:
+                self._snapshot(product.tcin, in_stock, signals, checked_at)
+
+    def _snapshot(self, tcin, in_stock, signals, now):
+        # Caller holds the condition. Returns (previous snapshot, changes), changes being None
+        # when no signal differs. A verdict flip on unchanged signals (e.g. the button) still
+        # gets its own snapshot; recorded snapshots are never modified.
+        ring = self.snapshots.get(tcin)
+        if ring is None:
+            ring = self.snapshots[tcin] = SnapshotRing(self.snapshot_history)
+        snapshot = SignalSnapshot(now, in_stock, signals)
+        previous = ring.latest()
+        changes = snapshot.diff(previous) if previous is not None else []
+        if previous is not None and not changes:
+            if previous.in_stock != in_stock:
+                ring.append(snapshot)
+            return previous, None
+        ring.append(snapshot)
+        return previous, changes
+
+    def update(self, product, result, now=None):
+        # Returns the signal changes since the product's last snapshot as [(field, old, new)],
+        # with whether they point toward a restock, or None when no signal changed.
+        now = time.time() if now is None else now
+        with self._cond:
+            item = self._item(product.tcin, product.name, product.url)
+            if result.in_stock is None: # Keep the last known verdict; just note the failed attempt
+                item["failure"], item["failed_at"] = result.failure, now
+                return None
+            previous = item["in_stock"]
+            item.update(in_stock=result.in_stock, signals=result.signals, rule=result.rule, checked_at=now, failure=None)
+            if previous != result.in_stock:
+                item["changed_at"] = now
+                self._publish({"type": "stock", "tcin": product.tcin, "name": product.name, "url": product.url,
+                               "in_stock": result.in_stock, "previous": previous, "rule": result.rule, "at": now})
+            if not result.signals:
+                return None
+            previous_snapshot, changes = self._snapshot(product.tcin, result.in_stock, result.signals, now)
+            if not changes:
+                return None
+            toward = not result.in_stock and moving_toward_availability(previous_snapshot.signals(), result.signals)
+            self._publish({"type": "signals", "tcin": product.tcin, "name": product.name, "url": product.url,
+                           "changes": {field: [old, new] for field, old, new in changes},
+                           "toward_availability": toward, "in_stock": result.in_stock, "at": now})
+            return changes, toward
+
+    def update_store(self, product, status):
+        with self._cond:
+            stores = self._item(product.tcin, product.name, product.url)["stores"]
+            previous = stores.get(status.store_id)
+            changed = previous is None or previous["available"] != status.available
+            stores[status.store_id] = {"available": status.available, "signals": status.signals,
+                                       "checked_at": status.checked_at,
+                                       "changed_at": status.checked_at if changed else previous["changed_at"]}
+            if changed:
+                self._publish({"type": "store", "tcin": product.tcin, "name": product.name, "url": product.url,
+                               "store_id": status.store_id, "available": status.available,
+                               "previous": previous["available"] if previous else None, "at": status.checked_at})
+
+    def remove(self, tcin):
+        with self._cond:
+            self.items.pop(tcin, None)
+            self.snapshots.pop(tcin, None)
+
+    def get(self, tcin, history=False):
+        # history=True adds the product's signal snapshots, oldest first.
+        with self._cond:
+            item = self.items.get(tcin)
+            if item is None:
+                return None
+            item = dict(item, stores={store_id: dict(store) for store_id, store in item["stores"].items()})
+            if history:
+                item["history"] = [snapshot.as_dict() for snapshot in self.snapshots.get(tcin, ())]
+            return item
+
+    def all(self):
+        with self._cond:
+            tcins = list(self.items)
+        return {tcin: self.get(tcin) for tcin in tcins}
+
+    def events_since(self, since, timeout):
+        # Transitions with id > since, waiting up to timeout for one to happen. Returns (events, latest id).
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > since, timeout)
+            return [event for event in self.events if event["id"] > since], self.seq
+
+class StatusHandler(BaseHTTPRequestHandler):
+    # GET  /status/<tcin>             one product, with its signal history
+    # GET  /status[?tcins=a,b,c]      several products (all of them without tcins)
+    # POST /status {"tcins": [...]}   bulk lookup for long lists
+    # GET  /events?since=N&timeout=S  long poll for transitions and signal deltas after id N
+    # GET  /events/stream             server-sent events (resumes from Last-Event-ID)
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _lookup(self, tcins):
+        cache = self.server.cache
+        return {"products": cache.all() if tcins is None else {tcin: cache.get(tcin) for tcin in tcins}}
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = parse_qs(query)
+        cache = self.server.cache
+        if path == "/status":
+            tcins = params.get("tcins")
+            self._send_json(200, self._lookup([t for v in tcins for t in v.split(",") if t] if tcins else None))
+        elif path.startswith("/status/"):
+            item = cache.get(path[len("/status/"):], history=True)
+            self._send_json(200 if item else 404, item or {"error": "not watched"})
+        elif path == "/events":
+            try:
+                since = int(params.get("since", [cache.seq])[0])
+                timeout = min(float(params.get("timeout", ["30"])[0]), STATUS_MAX_WAIT)
+            except ValueError:
+                self._send_json(400, {"error": "since and timeout must be numbers"})
+                return
+            events, latest = cache.events_since(since, timeout)
+            self._send_json(200, {"events": events, "next": latest})
+        elif path == "/events/stream":
+            self._stream(cache, params)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/status":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            tcins = [str(tcin) for tcin in payload["tcins"]]
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": 'expected {"tcins": [...]}'})
+            return
+        self._send_json(200, self._lookup(tcins))
+
+    def _stream(self, cache, params):
+        try:
+            since = int(self.headers.get("Last-Event-ID") or params.get("since", [cache.seq])[0])
+        except ValueError:
+            since = cache.seq
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                events, since = cache.events_since(since, STATUS_HEARTBEAT)
+                if not events:
+                    self.wfile.write(b": keep-alive\n\n")
+                for event in events:
+                    self.wfile.write(f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def start_status_server(cache, port=STATUS_PORT, host=STATUS_HOST):
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    server.daemon_threads = True
+    server.cache = cache
+    threading.Thread(target=server.serve_forever, name="status-server", daemon=True).start()
+    log.info("🛰️ Status API available at http://%s:%s/status", host, server.server_address[1])
+    return server
+
+# === WATCHLIST ===
+class Product:
+    # One watched TCIN, resolved once at load time. `aliases` holds the names of any other
+    # watchlist entries (e.g. ?preselect= or #lnk= variants) that point at the same TCIN.
+    __slots__ = ("tcin", "name", "url", "interval", "aliases")
+
+    def __init__(self, tcin, name, url, interval, aliases=()):
+        self.tcin = tcin
+        self.name = name
+        self.url = url
+        self.interval = interval
+        self.aliases = aliases
+
+    def settings(self):
+        return (self.name, self.url, self.interval, self.aliases)
+
+    def __repr__(self):
+        return f"Product({self.tcin!r}, {self.name!r}, interval={self.interval})"
+
+WATCHLIST_SUFFIXES = (".json", ".csv", ".toml")
+
+def _watchlist_row(entry, source):
+    # Accepts {"name", "url", "interval"} dicts (interval optional); returns (name, url, interval).
+    if not isinstance(entry, dict) or not entry.get("url"):
+        raise ValueError(f"{source}: watchlist entries need at least a url, got {entry!r}")
+    url = str(entry["url"]).strip()
+    name = str(entry.get("name") or url).strip()
+    interval = entry.get("interval")
+    return (name, url, float(interval) if interval not in (None, "") else None)
+
+def _watchlist_rows(data, source):
+    # JSON and TOML share a shape: {name: url}, [entries], or {"products": {name: url} | [entries]}.
+    if isinstance(data, dict) and "products" in data:
+        data = data["products"]
+    if isinstance(data, dict):
+        return [_watchlist_row({"name": name, "url": value} if isinstance(value, str) else dict(value, name=name), source)
+                for name, value in data.items()]
+    if isinstance(data, list):
+        return [_watchlist_row(entry, source) for entry in data]
+    raise ValueError(f"{source}: expected a mapping or a list of products")
+
+def read_watchlist_file(path):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".csv":
+        with open(path, newline="", encoding="utf-8") as f:
+            return [_watchlist_row(row, path) for row in csv.DictReader(f)]
+    if suffix == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError(f"{path}: TOML watchlists need Python 3.11+") from None
+        with open(path, "rb") as f:
+            return _watchlist_rows(tomllib.load(f), path)
+    with open(path, encoding="utf-8") as f:
+        return _watchlist_rows(json.load(f), path)
+
+def build_registry(rows):
+    # Resolves (name, url, interval) rows into {tcin: Product}. Entries sharing a TCIN collapse
+    # into one product (first name and URL win) checked at the shortest interval any of them asks for.
+    registry = {}
+    for name, url, interval in rows:
+        tcin = get_tcin_from_url(url)
+        if not tcin:
+            log.warning("⚠️ Skipping watchlist entry %s: no TCIN in %s", name, url)
+            continue
+        if interval is None:
+            interval = PRODUCT_INTERVALS.get(name, CHECK_INTERVAL)
+        product = registry.get(tcin)
+        if product is None:
+            registry[tcin] = Product(tcin, name, url, interval)
+        else:
+            log.debug("TCIN %s is listed as both %s and %s; checking it once.", tcin, product.name, name)
+            if name != product.name and name not in product.aliases:
+                product.aliases += (name,)
+            product.interval = min(product.interval, interval)
+    return registry
+
+class Watchlist:
+    # The products to monitor, loaded from WATCHLIST_PATH (a file or a directory of files) or
+    # from a mapping. refresh() re-reads only files whose mtime or size changed; a file that
+    # fails to parse (e.g. caught mid-write) keeps its previous entries until it parses again.
+    def __init__(self, path=None, rows=None):
+        self.path = path
+        self.products = {}
+        self._files = {} # path -> (mtime_ns, size, rows)
+        self._static_rows = rows or []
+        self._next_poll = 0.0
+        if path is None:
+            self.products = build_registry(self._static_rows)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls(rows=[(name, url, None) for name, url in mapping.items()])
+
+    def _paths(self):
+        if os.path.isdir(self.path):
+            with os.scandir(self.path) as it:
+                return sorted(entry.path for entry in it
+                              if entry.is_file() and entry.name.lower().endswith(WATCHLIST_SUFFIXES))
+        return [self.path] if os.path.exists(self.path) else None
+
+    def refresh(self):
+        # Returns (added, removed, changed): new Products, TCINs that left, and Products whose settings changed.
+        if self.path is None:
+            return [], [], []
+        paths = self._paths()
+        if paths is None: # A missing watchlist file is treated as a transient state, not an empty list
+            log.warning("⚠️ Watchlist file %s not found; keeping the current products.", self.path)
+            return [], [], []
+        files = {}
+        reloaded = False
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            previous = self._files.get(path)
+            if previous and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+                files[path] = previous
+                continue
+            reloaded = True
+            try:
+                files[path] = (stat.st_mtime_ns, stat.st_size, read_watchlist_file(path))
+                metrics.inc("restock_watchlist_reloads_total", help_text="Watchlist file loads by outcome.", result="ok")
+            except (OSError, ValueError, csv.Error) as e:
+                log.warning("⚠️ Could not load watchlist file %s: %s", path, e)
+                metrics.inc("restock_watchlist_reloads_total", help_text="Watchlist file loads by outcome.", result="error")
+                if previous:
+                    files[path] = previous
+        if not reloaded and files.keys() == self._files.keys():
+            return [], [], []
+        self._files = files
+        registry = build_registry(row for _, _, rows in files.values() for row in rows)
+        old = self.products
+        added = [product for tcin, product in registry.items() if tcin not in old]
+        removed = [tcin for tcin in old if tcin not in registry]
+        changed = [product for tcin, product in registry.items()
+                   if tcin in old and old[tcin].settings() != product.settings()]
+        self.products = registry
+        if old or registry:
+            log.info("📋 Watchlist loaded: %s products (%s added, %s removed, %s changed).",
+                     len(registry), len(added), len(removed), len(changed))
+        return added, removed, changed
+
+    def poll(self, now):
+        # Rate-limited refresh() for the main loop.
+        if self.path is None or now < self._next_poll:
+            return [], [], []
+        self._next_poll = now + WATCHLIST_POLL_INTERVAL
+        return self.refresh()
+
+class HostLimiter:
+    # Caps in-flight requests per host and spaces out request starts to the same host,
+    # replacing the fixed sleep between products in the old sequential loop.
+    def __init__(self, max_in_flight=PER_HOST_CONCURRENCY, min_delay=PER_HOST_MIN_DELAY):
+        self.max_in_flight = max(1, max_in_flight)
+        self.min_delay = max(0.0, min_delay)
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).netloc.lower()
+        if fetch_governor.is_open(host): # The request will be refused unsent; don't spend spacing on it
+            yield
+            return
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self.max_in_flight)
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start_at = max(now, self._next_start.get(host, now), fetch_governor.paused_until(host))
+                self._next_start[host] = start_at + self.min_delay + fetch_governor.extra_delay(host)
+            if start_at > now:
+                time.sleep(start_at - now)
+            yield
+
+class CheckEngine:
+    # Runs product checks on a thread pool. Sweep time scales with the concurrency
+    # limits instead of with the length of the watchlist.
+    def __init__(self, max_workers=MAX_CONCURRENCY, host_limiter=None):
+        self.max_workers = max(1, max_workers)
+        self.host_limiter = host_limiter or HostLimiter()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="check")
+        self._pending = {}
+        self._page_fallback = set() # TCINs whose next check uses the product page
+        self.fallbacks = [] # Products the API couldn't answer, waiting to be rescheduled
+
+    def _check(self, product):
+        log.debug("🔍 Checking: %s (%s)", product.name, product.url)
+        with self.host_limiter.slot(product.url):
+            return [(product, check_product(product.url, product.tcin))]
+
+    def _check_api_batch(self, batch):
+        # batch is [Product]; returns None as the result for anything the API couldn't answer.
+        # A batch refused for throttling, blocking or an open circuit is an unknown verdict
+        # for every product instead: falling back would turn one refused request into a
+        # page fetch per product just when the site asked us to slow down.
+        log.debug("🔍 Checking %s products via product API", len(batch))
+        try:
+            with self.host_limiter.slot(PRODUCT_API_BATCH_URL):
+                statuses = api_stock_statuses(sorted(product.tcin for product in batch))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            kind = getattr(e, "kind", type(e).__name__)
+            metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type=f"api_{kind}")
+            if kind in API_NO_FALLBACK:
+                log.warning("⚠️ Product API batch refused (%s): %s. Verdicts unknown.", kind, e)
+                return [(product, CheckResult(None, None, kind)) for product in batch]
+            log.warning("Error checking product API batch: %s. Falling back to product pages.", e)
+            statuses = {}
+        return [(product, statuses.get(product.tcin)) for product in batch]
+
+    def submit(self, products):
+        # Queues checks for an iterable of Products; futures map to the Products they cover.
+        # Returns the number of requests that will cost.
+        products = list(products)
+        if FETCH_MODE != "api":
+            pages, products = products, []
+        else:
+            pages = [product for product in products if product.tcin in self._page_fallback]
+            products = [product for product in products if product.tcin not in self._page_fallback]
+            self._page_fallback.difference_update(product.tcin for product in pages)
+        size = max(1, PRODUCT_API_BATCH_SIZE)
+        for i in range(0, len(products), size):
+            batch = products[i:i + size]
+            self._pending[self.executor.submit(self._check_api_batch, batch)] = batch
+        for product in pages:
+            self._pending[self.executor.submit(self._check, product)] = [product]
+        return -(-len(products) // size) + len(pages)
+
+    def take_fallbacks(self):
+        # Products the API had no answer for; their next submit() fetches the product page.
+        fallbacks, self.fallbacks = self.fallbacks, []
+        return fallbacks
+
+    def in_flight(self):
+        return sum(len(items) for items in self._pending.values())
+
+    def collect(self, timeout=None):
+        # Returns [(Product, CheckResult)] for checks that finished within timeout.
+        # A check that raised is reported with a None result, leaving its alert state untouched.
+        if not self._pending:
+            return []
+        done, _ = wait(self._pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        completed = []
+        for future in done:
+            items = self._pending.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                for product in items:
+                    log.warning("⚠️ An unexpected error occurred in main loop for %s: %s", product.name, e)
+                    metrics.inc("restock_errors_total", help_text="Failed checks by error type.", type=type(e).__name__)
+                    completed.append((product, None))
+                continue
+            for product, result in results:
+                if result is None: # Product API had no answer; the page is fetched when rescheduled
+                    self._page_fallback.add(product.tcin)
+                    self.fallbacks.append(product)
+                else:
+                    metrics.inc("restock_verdicts_total", help_text="Check verdicts by the rule that decided them.",
+                                verdict="unknown" if result.in_stock is None else "in_stock" if result.in_stock else "out_of_stock",
+                                rule=result.rule or result.failure or "none")
+                    completed.append((product, result))
+        return completed
+
+    def run_sweep(self, products):
+        # Checks every product once, yielding (Product, CheckResult) as checks finish.
+        # Also accepts a {name: url} mapping such as PRODUCTS.
+        if isinstance(products, dict):
+            products = Watchlist.from_mapping(products).products.values()
+        with metrics.timer("restock_sweep_duration_seconds", LAG_BUCKETS, "Time to check every product once."):
+            self.submit(products)
+            while self._pending:
+                yield from self.collect()
+                self.submit(self.take_fallbacks())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# === SHARDING ===
+class ShardRing:
+    # Consistent hashing of TCINs onto worker IDs, SHARD_VNODES points per worker, so a
+    # worker joining or leaving only moves the TCINs on its own arcs of the ring.
+    def __init__(self, members, vnodes=SHARD_VNODES):
+        self.members = tuple(sorted(members))
+        points = sorted((self._hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._keys = [key for key, _ in points]
+        self._owners = [member for _, member in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+    def owner(self, tcin):
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, self._hash(tcin))
+        return self._owners[i % len(self._owners)]
+
+class ShardCoordinator:
+    # Membership and alert claims shared by the workers of one host through SQLite. Each
+    # worker heartbeats a row; the live rows are the ring's members. An alert is sent only by
+    # the worker whose claim row insert succeeds, and the claim is released once the product
+    # is seen out of stock again, so a TCIN that changes hands is never announced twice.
+    # Used only from the main loop's thread.
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat_at REAL)",
+        "CREATE TABLE IF NOT EXISTS alert_claims (key TEXT PRIMARY KEY, worker_id TEXT, claimed_at REAL)",
+    )
+
+    def __init__(self, path=None, worker_id=None, ttl=SHARD_WORKER_TTL):
+        self.path = path or SHARD_DB_PATH
+        self.worker_id = worker_id or WORKER_ID
+        self.ttl = ttl
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None) # Autocommit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+
+    def heartbeat(self, now=None):
+        # Returns the IDs of live workers, this one included.
+        now = time.time() if now is None else now
+        self.conn.execute("INSERT INTO workers (worker_id, heartbeat_at) VALUES (?, ?) ON CONFLICT(worker_id)"
+                          " DO UPDATE SET heartbeat_at = excluded.heartbeat_at", (self.worker_id, now))
+        self.conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (now - self.ttl,))
+        return [row[0] for row in self.conn.execute("SELECT worker_id FROM workers")]
+
+    def leave(self):
+        # A worker that can't deregister simply ages out after SHARD_WORKER_TTL.
+        try:
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not leave the shard in %s: %s", self.path, e)
+
+    def claim_alert(self, key, now=None):
+        # True if this worker should send the alert. Fails open: a duplicate beats a missed restock.
+        try:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO alert_claims (key, worker_id, claimed_at) VALUES (?, ?, ?)",
+                                       (key, self.worker_id, time.time() if now is None else now))
+            return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not claim alert %s in %s: %s. Alerting anyway.", key, self.path, e)
+            return True
+
+    def release_alert(self, key):
+        try:
+            self.conn.execute("DELETE FROM alert_claims WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not release alert claim %s in %s: %s", key, self.path, e)
+
+    def release_product(self, tcin):
+        # Drops the online and every store claim for a TCIN that left the watchlist.
+        try:
+            self.conn.execute("DELETE FROM alert_claims WHERE key = ? OR key LIKE ?", (tcin, f"{tcin}@%"))
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not release alert claims for %s in %s: %s", tcin, self.path, e)
+
+    def claimed(self):
+        # The claimed alert keys, or None if they couldn't be read.
+        try:
+            return {row[0] for row in self.conn.execute("SELECT key FROM alert_claims")}
+        except sqlite3.Error as e:
+            log.warning("⚠️ Could not read alert claims from %s: %s", self.path, e)
+            return None
+
+    def close(self):
+        self.conn.close()
+
+class Shard:
+    # This worker's slice of the watchlist. With a coordinator the ring follows the live
+    # workers and refresh() reports when it changed; without one it is WORKER_INDEX of a
+    # fixed WORKER_COUNT (e.g. Heroku dynos, which share no filesystem).
+    def __init__(self, coordinator=None, index=WORKER_INDEX, count=WORKER_COUNT, heartbeat=SHARD_HEARTBEAT):
+        self.coordinator = coordinator
+        self.heartbeat = heartbeat
+        self.next_heartbeat = 0.0
+        if coordinator is None:
+            self.worker_id = f"worker-{index}"
+            self.ring = ShardRing(f"worker-{i}" for i in range(max(1, count)))
+        else:
+            self.worker_id = coordinator.worker_id
+            self.ring = ShardRing(())
+
+    def owns(self, tcin):
+        return self.ring.owner(tcin) == self.worker_id
+
+    def refresh(self, now):
+        # Heartbeats every SHARD_HEARTBEAT seconds; True when the membership changed.
+        if self.coordinator is None or now < self.next_heartbeat:
+            return False
+        self.next_heartbeat = now + self.heartbeat
+        try:
+            members = self.coordinator.heartbeat()
+        except sqlite3.Error as e:
+            log.warning("⚠️ Shard heartbeat failed: %s. Keeping the current shard.", e)
+            return False
+        if tuple(sorted(members)) == self.ring.members:
+            return False
+        log.info("🧩 Workers now %s; rebalancing shards.", ", ".join(sorted(members)))
+        self.ring = ShardRing(members)
+        return True
+
+    def leave(self):
+        if self.coordinator is not None:
+            self.coordinator.leave()
+            self.coordinator.close()
+
+shard_coordinator = None # Set by main() when SHARD_DB_PATH is configured
+
+# === SCHEDULER ===
+class TokenBucket:
+    # Global request budget: refills at rate_per_minute, holds at most capacity tokens.
+    def __init__(self, rate_per_minute=REQUESTS_PER_MINUTE, capacity=REQUEST_BURST, now=None):
+        self.rate = max(rate_per_minute, 0.001) / 60.0
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return int(self.tokens)
+
+    def consume(self, count, now):
+        self._refill(now)
+        self.tokens -= count
+
+    def wait_time(self, now):
+        # Seconds until at least one whole token is available.
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class ScheduleEntry:
+    __slots__ = ("product", "base_interval", "interval", "next_due", "hot_checks_left", "last_result", "in_flight")
+
+    def __init__(self, product, next_due):
+        self.product = product
+        self.base_interval = product.interval
+        self.interval = product.interval
+        self.next_due = next_due
+        self.hot_checks_left = 0
+        self.last_result = None
+        self.in_flight = False
+
+def street_date_is_close(street_date_str, now_utc=None):
+    if not street_date_str:
+        return False
     try:
-        response = requests.post(DISCORD_WEBHOOK_URL, json=data, timeout=10)
-        response.raise_for_status()
-        print(f"✅ Alert sent for {product_name}: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"🚨 Failed to send Discord alert for {product_name}: {e}")
-    except Exception as e:
-        print(f"🚨 An unexpected error occurred while sending Discord alert: {e}")
+        street_date = datetime.strptime(street_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return False
+    now_utc = now_utc or datetime.now(timezone.utc)
+    return now_utc - timedelta(days=1) <= street_date <= now_utc + timedelta(days=HOT_STREET_DATE_DAYS)
+
+def moving_toward_availability(previous, current):
+    # True when the JSON signals of a still-OOS product shift in the direction of a restock:
+    # the ONLINE reason leaves OUT_OF_STOCK, order_limit moves off 0, purchasable flips on,
+    # or a street date is about to arrive.
+    if not current:
+        return False
+    if street_date_is_close(current.get("street_date")):
+        return True
+    if not previous:
+        return False
+    if previous["online_reason"] != current["online_reason"] and current["online_reason"] not in ("OUT_OF_STOCK", "UNKNOWN"):
+        return True
+    if previous["order_limit"] == 0 and current["order_limit"] != 0:
+        return True
+    if previous["purchasable"] is False and current["purchasable"] is not False:
+        return True
+    if not previous["online_eligible"] and current["online_eligible"]:
+        return True
+    return False
+
+class Scheduler:
+    # Keeps a next-due time per product in a heap. Unchanged products back off
+    # exponentially, changes reset to the base interval, and products whose JSON signals
+    # move toward availability go "hot" and are polled every HOT_INTERVAL seconds.
+    # Callers pass `now` explicitly so the scheduler can run on a simulated clock.
+    def __init__(self, rng=None):
+        self.entries = {}
+        self._heap = []
+        self._seq = 0
+        self.rng = rng or random.Random()
+
+    def _push(self, entry):
+        self._seq += 1
+        heapq.heappush(self._heap, (entry.next_due, self._seq, entry.product.tcin))
+
+    def _jittered(self, interval):
+        return interval * (1 + self.rng.uniform(-SCHEDULE_JITTER, SCHEDULE_JITTER))
+
+    def add(self, product, now):
+        # New products are spread across their first interval instead of all firing at once.
+        entry = ScheduleEntry(product, now + self.rng.uniform(0, min(product.interval, 5.0)))
+        self.entries[product.tcin] = entry
+        self._push(entry)
+
+    def update(self, product, now):
+        # Applies reloaded watchlist settings while keeping backoff/hot state and the last result.
+        entry = self.entries.get(product.tcin)
+        if entry is None:
+            self.add(product, now)
+            return
+        entry.product = product
+        if entry.base_interval != product.interval:
+            entry.base_interval = product.interval
+            entry.interval = min(entry.interval, product.interval)
+            if not entry.in_flight and entry.next_due > now + product.interval:
+                entry.next_due = now + self._jittered(product.interval)
+                self._push(entry)
+
+    def remove(self, tcin):
+        self.entries.pop(tcin, None) # Stale heap items are skipped when popped
+
+    def retry(self, tcin, now):
+        # Puts an in-flight entry straight back on the heap, due now, without counting a check.
+        entry = self.entries.get(tcin)
+        if entry is None:
+            return
+        entry.in_flight = False
+        entry.next_due = now
+        self._push(entry)
+
+    def next_due(self):
+        while self._heap:
+            due, _, tcin = self._heap[0]
+            entry = self.entries.get(tcin)
+            if entry is not None and entry.next_due == due and not entry.in_flight:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now, limit):
+        # Returns up to `limit` due entries; they stay off the heap until rescheduled.
+        due = []
+        while len(due) < limit:
+            next_due = self.next_due()
+            if next_due is None or next_due > now:
+                break
+            _, _, tcin = heapq.heappop(self._heap)
+            entry = self.entries[tcin]
+            entry.in_flight = True
+            due.append(entry)
+        return due
+
+    def reschedule(self, tcin, result, now):
+        entry = self.entries.get(tcin)
+        if entry is None:
+            return
+        entry.in_flight = False
+        previous = entry.last_result
+        if result is None or result.in_stock is None:
+            # Check failed: retry at the base pace, or keep the hot pace near a restock. Slowing
+            # down for a throttled host is the FetchGovernor's job, not this product's.
+            entry.interval = min(HOT_INTERVAL, entry.base_interval) if entry.hot_checks_left > 0 else entry.base_interval
+        elif moving_toward_availability(previous.signals if previous else None, result.signals) and not result.in_stock:
+            if entry.hot_checks_left == 0:
+                log.info("🔥 %s looks close to a restock, polling every %.0fs.", entry.product.name, HOT_INTERVAL)
+            entry.hot_checks_left = HOT_CHECKS
+            entry.interval = min(HOT_INTERVAL, entry.base_interval)
+        elif entry.hot_checks_left > 0 and not result.in_stock:
+            entry.hot_checks_left -= 1
+            entry.interval = min(HOT_INTERVAL, entry.base_interval) if entry.hot_checks_left else entry.base_interval
+        elif previous is None or previous != result:
+            entry.hot_checks_left = 0
+            entry.interval = entry.base_interval
+        else:
+            entry.interval = min(entry.interval * BACKOFF_FACTOR, max(entry.base_interval, MAX_BACKOFF_INTERVAL))
+        if result is not None and result.in_stock is not None:
+            entry.last_result = result
+        entry.next_due = now + self._jittered(entry.interval)
+        self._push(entry)
+
+def update_alert_state(product, in_stock_status):
+    # One alert per OOS -> in-stock transition, tracked by TCIN through alerted_items (and,
+    # when sharded with a coordinator, a claim every worker sees).
+    name = product.name
+    if in_stock_status:
+        if product.tcin not in alerted_items:
+            alerted_items.add(product.tcin) # Before queueing, so a delivery confirmation always finds it
+            if shard_coordinator is None or shard_coordinator.claim_alert(product.tcin):
+                log.info("✅ %s IN STOCK! Queueing alert...", name)
+                send_discord_alert(name, product.url, product.tcin)
+            else:
+                log.info("ℹ️ %s is in stock but another worker already alerted.", name)
+        else:
+            log.debug("ℹ️ %s is in stock but already alerted.", name)
+    else:
+        log.debug("❌ %s is out of stock.", name)
+        if product.tcin in alerted_items:
+            log.info("🗑️ Resetting alert status for %s as it's now OOS.", name)
+            alerted_items.discard(product.tcin)
+            if shard_coordinator is not None:
+                shard_coordinator.release_alert(product.tcin)
+
+def update_store_alert_state(product, status):
+    # Same as update_alert_state, but one alert per (TCIN, store) unavailable -> available transition.
+    key = (product.tcin, status.store_id)
+    label = f"{product.name} at {status.signals.get('store_name') or 'store ' + status.store_id}"
+    if status.available:
+        if key not in alerted_store_items:
+            alerted_store_items.add(key)
+            if shard_coordinator is None or shard_coordinator.claim_alert(f"{product.tcin}@{status.store_id}"):
+                log.info("✅ %s AVAILABLE FOR PICKUP! Queueing alert...", label)
+                send_discord_alert(f"{label} (pickup)", product.url, f"{product.tcin}@{status.store_id}")
+            else:
+                log.info("ℹ️ %s is available for pickup but another worker already alerted.", label)
+        else:
+            log.debug("ℹ️ %s is available for pickup but already alerted.", label)
+    else:
+        log.debug("❌ %s is not available for pickup.", label)
+        if key in alerted_store_items:
+            log.info("🗑️ Resetting pickup alert status for %s as it's now unavailable.", label)
+            alerted_store_items.discard(key)
+            if shard_coordinator is not None:
+                shard_coordinator.release_alert(f"{product.tcin}@{status.store_id}")
+
+def runtime_metrics(engine, scheduler, state=None, stores=None, shard=None):
+    # Point-in-time values sampled whenever /metrics is scraped.
+    def collect():
+        samples = [
+            ("restock_checks_in_flight", "gauge", "Product checks currently running.", {}, engine.in_flight()),
+            ("restock_products_scheduled", "gauge", "Products on the schedule.", {}, len(scheduler.entries)),
+            ("restock_alert_queue_depth", "gauge", "Alerts waiting for delivery.", {},
+             _alert_dispatcher.queue_depth() if _alert_dispatcher is not None else 0),
+            ("restock_state_pending_writes", "gauge", "State updates waiting to be committed.", {},
+             state.pending() if state is not None else 0),
+            ("restock_capture_pending_writes", "gauge", "Captured fetches waiting to be written.", {},
+             capture_archive.pending() if capture_archive is not None else 0),
+            ("restock_store_results_cached", "gauge", "(Product, store) availability answers in the cache.", {},
+             len(stores.cache) if stores is not None else 0),
+            ("restock_shard_workers", "gauge", "Workers sharing the watchlist.", {},
+             len(shard.ring.members) if shard is not None else 1),
+        ]
+        for key, value in change_detector.stats().items():
+            samples.append((f"restock_change_detector_{key}_total", "counter", f"Change detector {key.replace('_', ' ')}.", {}, value))
+        hosts, identities = fetch_governor.stats()
+        for host, breaker_state, extra_delay in hosts:
+            samples.append(("restock_circuit_open", "gauge", "1 while a host's circuit breaker is open or probing.",
+                            {"host": host}, int(breaker_state != "closed")))
+            samples.append(("restock_host_extra_delay_seconds", "gauge", "Extra request spacing added after throttling.",
+                            {"host": host}, extra_delay))
+        for name, score in identities:
+            samples.append(("restock_identity_health", "gauge", "Health score of each request identity (0-1).",
+                            {"identity": name}, round(score, 4)))
+        return samples
+    return collect
 
 def main():
+    global capture_archive, shard_coordinator
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
     if not DISCORD_WEBHOOK_URL:
-        print("⚠️ DISCORD_WEBHOOK_URL environment variable not found. Alerts will not be sent.")
+        log.warning("⚠️ DISCORD_WEBHOOK_URL environment variable not found. Alerts will not be sent.")
 
-    print("🛒 Starting Target product restock monitor...")
-    print(f"Checking {len(PRODUCTS)} products every {CHECK_INTERVAL} seconds.")
-    
-    while True:
-        for name, url in PRODUCTS.items():
-            try:
-                print(f"🔍 Checking: {name} ({url})")
-                in_stock_status = is_in_stock(url)
-                
-                if in_stock_status:
-                    if name not in alerted_items:
-                        print(f"✅ {name} IN STOCK! Sending alert...")
-                        send_discord_alert(name, url)
-                        alerted_items.add(name)
-                    else:
-                        print(f"ℹ️ {name} is in stock but already alerted.")
+    log.info("🛒 Starting Target product restock monitor...")
+    watchlist = Watchlist(WATCHLIST_PATH) if WATCHLIST_PATH else Watchlist.from_mapping(PRODUCTS)
+    watchlist.poll(time.monotonic())
+    log.info("Checking %s products every %s seconds (backing off to %.0fs, hot mode %.0fs, budget %.0f requests/min, "
+             "%s concurrent, %s per host, fetch mode: %s, parser processes: %s).", len(watchlist.products), CHECK_INTERVAL,
+             MAX_BACKOFF_INTERVAL, HOT_INTERVAL, REQUESTS_PER_MINUTE, MAX_CONCURRENCY, PER_HOST_CONCURRENCY, FETCH_MODE,
+             PARSE_WORKERS or "inline")
+
+    engine = CheckEngine()
+    scheduler = Scheduler()
+    budget = TokenBucket()
+    store_monitor = StoreMonitor(engine)
+    if store_monitor.enabled:
+        log.info("🏬 Checking pickup at stores %s every %.0fs.",
+                 ", ".join(store_monitor.store_ids + [f"near {zip_code}" for zip_code in store_monitor.zips]),
+                 store_monitor.interval)
+    availability = AvailabilityCache()
+    shard = None
+    if SHARD_DB_PATH:
+        shard_coordinator = ShardCoordinator(SHARD_DB_PATH)
+        shard = Shard(shard_coordinator)
+        shard.refresh(time.monotonic())
+        log.info("🧩 Sharding as %s with %s coordinating.", shard.worker_id, SHARD_DB_PATH)
+    elif WORKER_COUNT > 1:
+        shard = Shard()
+        log.info("🧩 Sharding as worker %s of %s.", WORKER_INDEX + 1, WORKER_COUNT)
+    now = time.monotonic()
+    # With a coordinator, the first checks wait a heartbeat so workers that haven't seen this one yet let go first.
+    first_due = now + (SHARD_HEARTBEAT if shard_coordinator is not None else 0)
+    for product in watchlist.products.values():
+        if shard is None or shard.owns(product.tcin):
+            scheduler.add(product, first_due)
+    if shard is not None:
+        log.info("🧩 This worker checks %s of %s products.", len(scheduler.entries), len(watchlist.products))
+    # Warm restart: restore alert flags and last results so nothing is re-alerted and backoff carries on.
+    state = StateStore(STATE_DB_PATH) if STATE_DB_PATH else None
+    if state is not None:
+        for tcin, saved in state.load().items():
+            tcin, _, store_id = tcin.partition("@")
+            entry = scheduler.entries.get(tcin)
+            if entry is None:
+                continue
+            if store_id:
+                if saved.alerted:
+                    alerted_store_items.add((tcin, store_id))
+                continue
+            if saved.alerted:
+                alerted_items.add(tcin)
+            entry.last_result = CheckResult(saved.in_stock, saved.signals)
+            availability.seed(entry.product, saved.in_stock, saved.signals, saved.checked_at, saved.changed_at)
+        state.start()
+
+        def alert_delivered(key):
+            # A delivery that lands after the product went unavailable again is not persisted.
+            tcin, _, store_id = key.partition("@")
+            if ((tcin, store_id) in alerted_store_items) if store_id else (tcin in alerted_items):
+                state.alert_delivered(key)
+
+        if DISCORD_WEBHOOK_URL:
+            get_alert_dispatcher().on_delivered = alert_delivered
+
+    def adopt_alert_claims(tcins):
+        # Shared claims outrank this worker's own journal: another worker may have alerted or reset since.
+        # If the claims can't be read, the journal is all there is to go on.
+        claims = shard_coordinator.claimed()
+        if claims is None:
+            return
+        tcins = set(tcins)
+        alerted_items.difference_update(tcins)
+        alerted_store_items.difference_update([key for key in alerted_store_items if key[0] in tcins])
+        for key in claims:
+            tcin, _, store_id = key.partition("@")
+            if tcin in tcins:
+                if store_id:
+                    alerted_store_items.add((tcin, store_id))
                 else:
-                    print(f"❌ {name} is out of stock.")
-                    if name in alerted_items:
-                        print(f"🗑️ Resetting alert status for {name} as it's now OOS.")
-                        alerted_items.discard(name)
-            except Exception as e:
-                print(f"⚠️ An unexpected error occurred in main loop for {name}: {e}")
-            
-            time.sleep(3) 
+                    alerted_items.add(tcin)
+
+    def drop(tcin):
+        scheduler.remove(tcin)
+        unchecked.discard(tcin)
+        alerted_items.discard(tcin)
+        store_monitor.forget(tcin)
+        change_detector.forget(tcin)
+        availability.remove(tcin)
+        alerted_store_items.difference_update([key for key in alerted_store_items if key[0] == tcin])
+
+    if shard_coordinator is not None:
+        adopt_alert_claims(scheduler.entries)
+    products_per_request = max(1, PRODUCT_API_BATCH_SIZE) if FETCH_MODE == "api" else 1
+    metrics.register_callback(runtime_metrics(engine, scheduler, state, store_monitor, shard))
+    if METRICS_PORT:
+        start_metrics_server()
+    if STATUS_PORT:
+        start_status_server(availability)
+    if CAPTURE_DIR:
+        capture_archive = CaptureArchive(CAPTURE_DIR).start()
+        log.info("📼 Capturing product page fetches to %s.", CAPTURE_DIR)
+
+    # A "sweep" ends once every product has been checked at least once since the last one ended.
+    unchecked = set(scheduler.entries)
+    sweep_started = now
+
+    try:
+        while True:
+            now = time.monotonic()
+            # Watchlist edits apply between iterations; checks already in flight finish untouched.
+            added, removed, changed = watchlist.poll(now)
+            for tcin in removed:
+                drop(tcin)
+                if shard_coordinator is not None:
+                    shard_coordinator.release_product(tcin)
+            for product in added:
+                if shard is None or shard.owns(product.tcin):
+                    scheduler.add(product, now)
+            for product in changed:
+                if product.tcin in scheduler.entries:
+                    scheduler.update(product, now)
+            # Workers joined or left: drop TCINs that moved away at once, start gained ones a
+            # heartbeat from now, by when their previous owner has seen the change too.
+            if shard is not None and shard.refresh(now):
+                gained = []
+                for product in watchlist.products.values():
+                    owned = shard.owns(product.tcin)
+                    if owned and product.tcin not in scheduler.entries:
+                        scheduler.add(product, now + shard.heartbeat)
+                        gained.append(product.tcin)
+                    elif not owned and product.tcin in scheduler.entries:
+                        drop(product.tcin)
+                adopt_alert_claims(gained)
+                log.info("🧩 This worker checks %s of %s products.", len(scheduler.entries), len(watchlist.products))
+
+            due = scheduler.pop_due(now, budget.available(now) * products_per_request)
+            if due:
+                for entry in due:
+                    metrics.observe("restock_queue_lag_seconds", now - entry.next_due, LAG_BUCKETS,
+                                    "How late checks start relative to their scheduled time.")
+                # Page fallbacks cost a request each, so this can overdraw the budget; the
+                # bucket then stays empty until the debt is paid back.
+                budget.consume(engine.submit(entry.product for entry in due), now)
+
+            if store_monitor.due(now) and budget.available(now) > 0:
+                products = [entry.product for entry in scheduler.entries.values()]
+                budget.consume(store_monitor.start_sweep(products, now), now)
+            for product, status in store_monitor.collect():
+                entry = scheduler.entries.get(product.tcin)
+                if entry is None:
+                    continue
+                availability.update_store(entry.product, status)
+                try:
+                    update_store_alert_state(entry.product, status)
+                    if state is not None:
+                        state.record(entry.product, CheckResult(status.available, status.signals),
+                                     (product.tcin, status.store_id) in alerted_store_items,
+                                     key=f"{product.tcin}@{status.store_id}")
+                except Exception as e:
+                    log.warning("⚠️ An unexpected error occurred in main loop for %s: %s", product.name, e)
+
+            # Wait for in-flight checks, but no longer than until the next product is due.
+            next_due = scheduler.next_due()
+            timeout = 1.0 if next_due is None else max(next_due - time.monotonic(), budget.wait_time(time.monotonic()), 0.05)
+            if engine.in_flight():
+                completed = engine.collect(timeout=min(timeout, 1.0))
+            else:
+                time.sleep(min(timeout, 1.0))
+                completed = []
+            # Products the API couldn't answer go back on the schedule for a page fetch within the budget.
+            for product in engine.take_fallbacks():
+                scheduler.retry(product.tcin, time.monotonic())
+
+            for product, result in completed:
+                entry = scheduler.entries.get(product.tcin)
+                if entry is None: # Removed from the watchlist while in flight
+                    continue
+                product = entry.product # Settings may have been reloaded since submission
+                delta = availability.update(product, result) if result is not None else None
+                if delta is not None:
+                    changes, toward = delta
+                    for field, _, _ in changes:
+                        metrics.inc("restock_signal_changes_total", help_text="Decision signal changes by field.", field=field)
+                    log.log(logging.INFO if toward else logging.DEBUG, "%s %s: %s", "📈" if toward else "🔀", product.name,
+                            ", ".join(f"{field} {old!r} -> {new!r}" for field, old, new in changes))
+                try:
+                    if result is not None and result.in_stock is not None: # Unknown verdicts leave alert state alone
+                        update_alert_state(product, result.in_stock)
+                        if state is not None:
+                            state.record(product, result, product.tcin in alerted_items)
+                except Exception as e:
+                    log.warning("⚠️ An unexpected error occurred in main loop for %s: %s", product.name, e)
+                scheduler.reschedule(product.tcin, result, time.monotonic())
+                unchecked.discard(product.tcin)
 
-        print(f"--- Loop finished, sleeping for {CHECK_INTERVAL} seconds ---")
-        time.sleep(CHECK_INTERVAL)
+            if not unchecked and scheduler.entries:
+                now = time.monotonic()
+                log.info("--- Sweep of %s products finished in %.1fs ---", len(scheduler.entries), now - sweep_started)
+                metrics.observe("restock_sweep_duration_seconds", now - sweep_started, LAG_BUCKETS,
+                                "Time to check every product once.")
+                unchecked = set(scheduler.entries)
+                sweep_started = now
+    finally:
+        engine.shutdown()
+        shutdown_parse_pool()
+        if _alert_dispatcher is not None:
+            _alert_dispatcher.stop()
+        if state is not None:
+            state.stop()
+        if capture_archive is not None:
+            capture_archive.stop()
+        if shard is not None:
+            shard.leave()
+        get_http_client().close()
 
 if __name__ == "__main__":
-    if not PRODUCTS:
-        print("🚫 No products configured in the PRODUCTS dictionary. Exiting.")
+    if not PRODUCTS and not WATCHLIST_PATH:
+        logging.basicConfig(level=LOG_LEVEL)
+        log.warning("🚫 No products configured in the PRODUCTS dictionary or WATCHLIST_PATH. Exiting.")
     else:
         main()